@@ -0,0 +1,67 @@
+"""
+Cold start benchmark of the web process: imports everything web.py imports in a fresh interpreter and
+reports how long that takes, and checks the crawl stack (scrapy, twisted, rdflib, lxml) stays out of it.
+
+    python benchmarks/cold_start.py                    # 10 runs, exits with 1 when the crawl stack is loaded
+    python benchmarks/cold_start.py --max-seconds 0.5  # also exits with 1 when the median is slower
+
+Run it in the service container, web.py needs the template's `helpers` and `escape_helpers`. The
+service logs its own load time on startup and reports it on `/ready`.
+"""
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# only needed by the crawler processes
+CRAWL_STACK = ["scrapy", "twisted", "rdflib", "lxml"]
+
+
+def web_imports(path=os.path.join(ROOT, "web.py")):
+    """Top level import statements of web.py"""
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    return [ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+
+def measure(imports):
+    code = "\n".join([
+        "import json, sys, time",
+        "start = time.perf_counter()",
+        *imports,
+        "seconds = time.perf_counter() - start",
+        f"print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {CRAWL_STACK!r} if m in sys.modules]}}))",
+    ])
+    env = dict(os.environ, DEFAULT_GRAPH=os.environ.get("DEFAULT_GRAPH", "http://mu.semte.ch/graphs/scraper-graph"))
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-seconds", type=float, help="fail when the median import time is higher")
+    args = parser.parse_args()
+
+    imports = web_imports()
+    results = [measure(imports) for _ in range(args.runs)]
+    seconds = sorted(result["seconds"] for result in results)
+    loaded = sorted({module for result in results for module in result["loaded"]})
+    print(f"web.py imports in {statistics.median(seconds) * 1000:.0f} ms (median of {args.runs}, "
+          f"min {seconds[0] * 1000:.0f} ms, max {seconds[-1] * 1000:.0f} ms)")
+    failed = False
+    if loaded:
+        print(f"REGRESSION: the web process loads the crawl stack: {', '.join(loaded)}")
+        failed = True
+    if args.max_seconds and statistics.median(seconds) > args.max_seconds:
+        print(f"REGRESSION: median import time above {args.max_seconds} seconds")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Benchmark of the crawl hot path: replays the pages in benchmarks/corpus through LBLODSpider.parse,
+doc_type_from_type_ofs, clean_url and Pipeline.process_item, with a local stub for the SPARQL endpoint.
+
+    python benchmarks/run.py                  # run and compare with benchmarks/baseline.json
+    python benchmarks/run.py --save-baseline  # run and store the results as the new baseline
+
+Exits with 1 when pages/sec, a stage's p95 latency or the peak RSS regressed more than --tolerance
+compared to the baseline.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import sparql_stub
+
+# has to be configured before the service modules are imported
+ENDPOINT = sparql_stub.serve()
+os.environ["MU_SPARQL_ENDPOINT"] = ENDPOINT
+os.environ["MU_SPARQL_UPDATEPOINT"] = ENDPOINT
+os.environ.setdefault("DEFAULT_GRAPH", "http://mu.semte.ch/graphs/scraper-graph")
+os.environ.setdefault("INCREMENTAL_RETRIEVAL", "false")
+
+from twisted.internet import defer, task
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from helpers import logger
+from lblod import pipelines
+from lblod.extractor import extract_annotations
+from lblod.harvester import clean_url
+from lblod.items import Page
+from lblod.spiders.lblod import LBLODSpider, doc_type_from_type_ofs
+
+STAGES = ["parse", "doc_type_from_type_ofs", "clean_url", "process_item"]
+BASE_URL = "https://publicatie.gelinkt-notuleren.vlaanderen.be/Voorbeeld/Gemeente/"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def load_corpus(path):
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".html"):
+            with open(os.path.join(path, name), "rb") as f:
+                pages.append((BASE_URL + name, f.read()))
+    return pages
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        raise SystemExit(f"no pages found in {args.corpus}")
+    storage = tempfile.mkdtemp(prefix="scraper-benchmark-")
+    pipelines.STORAGE_PATH = storage
+    crawler = get_crawler(LBLODSpider)
+    spider = LBLODSpider.from_crawler(
+        crawler,
+        start_urls=[BASE_URL],
+        collection="http://data.lblod.info/id/harvest-collections/benchmark",
+        task="http://data.lblod.info/id/tasks/benchmark",
+        job_id="benchmark"
+    )
+    pipeline = pipelines.Pipeline()
+    yield pipeline.open_spider(spider)
+
+    timings = {stage: [] for stage in STAGES}
+    pages = 0
+    items = 0
+    start = time.perf_counter()
+    for iteration in range(args.iterations):
+        # a fresh store per iteration, otherwise deduplication skips compressing the pages again
+        pipeline.storage_path = os.path.join(storage, str(iteration))
+        for url, body in corpus:
+            response = HtmlResponse(url=url, body=body, encoding="utf-8", request=Request(url))
+
+            t = time.perf_counter()
+            results = list(spider.parse(response))
+            timings["parse"].append(time.perf_counter() - t)
+
+            type_ofs, links = extract_annotations(response.text)
+            t = time.perf_counter()
+            doc_type_from_type_ofs(type_ofs)
+            timings["doc_type_from_type_ofs"].append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            for href, _ in links:
+                clean_url(response.urljoin(href))
+            timings["clean_url"].append(time.perf_counter() - t)
+
+            for result in results:
+                if isinstance(result, Page):
+                    t = time.perf_counter()
+                    yield pipeline.process_item(result, spider)
+                    timings["process_item"].append(time.perf_counter() - t)
+                    items += 1
+            pages += 1
+    t = time.perf_counter()
+    yield pipeline.writer.close()
+    flush = time.perf_counter() - t
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(storage)
+
+    return {
+        "pages": pages,
+        "items": items,
+        "elapsed_seconds": elapsed,
+        "pages_per_second": pages / elapsed,
+        "final_flush_seconds": flush,
+        "peak_rss_mb": peak_rss_mb(),
+        "sparql": dict(sparql_stub.counts),
+        "stages": {
+            stage: {f"p{p}_ms": percentile(values, p) * 1000 for p in (50, 95, 99)}
+            for stage, values in timings.items()
+        }
+    }
+
+
+def report(results):
+    print(f"{results['pages']} pages ({results['items']} items) in {results['elapsed_seconds']:.2f}s: "
+          f"{results['pages_per_second']:.1f} pages/sec, peak RSS {results['peak_rss_mb']:.1f} MB, "
+          f"{results['sparql']['queries']} SPARQL queries, {results['sparql']['updates']} updates")
+    print(f"{'stage':<24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, latencies in results["stages"].items():
+        print(f"{stage:<24}{latencies['p50_ms']:>10.3f}{latencies['p95_ms']:>10.3f}{latencies['p99_ms']:>10.3f}")
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results compared to baseline"""
+    regressions = []
+    if results["pages_per_second"] < baseline["pages_per_second"] * (1 - tolerance):
+        regressions.append(f"pages/sec {results['pages_per_second']:.1f} < baseline {baseline['pages_per_second']:.1f}")
+    if results["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak RSS {results['peak_rss_mb']:.1f} MB > baseline {baseline['peak_rss_mb']:.1f} MB")
+    for stage, latencies in results["stages"].items():
+        expected = baseline["stages"].get(stage)
+        if expected and latencies["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{stage} p95 {latencies['p95_ms']:.3f} ms > baseline {expected['p95_ms']:.3f} ms")
+    return regressions
+
+
+@defer.inlineCallbacks
+def benchmark(reactor, args):
+    results = yield run(reactor, args)
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"stored baseline in {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print(f"no regressions compared to {args.baseline}")
+    else:
+        print(f"no baseline at {args.baseline}, store one with --save-baseline")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=os.path.join(BENCHMARK_DIR, "corpus"), help="folder with the html pages to replay")
+    parser.add_argument("--iterations", type=int, default=20, help="number of times the corpus is replayed")
+    parser.add_argument("--baseline", default=os.path.join(BENCHMARK_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression compared to the baseline, 0.2 = 20%%")
+    parser.add_argument("--output", help="also write the results as json to this file")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the service while benchmarking")
+    args = parser.parse_args()
+    logger.setLevel(args.log_level)
+
+    task.react(benchmark, (args,))
+
+
+if __name__ == "__main__":
+    main()
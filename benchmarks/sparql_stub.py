@@ -0,0 +1,52 @@
+"""
+Minimal stand-in for the SPARQL endpoint, answers every SELECT with no results and every ASK with true.
+Updates are accepted and dropped. Requests are counted so the benchmark can report them.
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+counts = {"queries": 0, "updates": 0}
+_lock = threading.Lock()
+
+
+class SparqlStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._answer(parse_qs(urlparse(self.path).query).get("query", [""])[0], update=False)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        form = parse_qs(body)
+        if "update" in form:
+            self._answer(form["update"][0], update=True)
+        else:
+            self._answer((form.get("query") or [body])[0], update=False)
+
+    def _answer(self, query, update):
+        with _lock:
+            counts["updates" if update else "queries"] += 1
+        if not update and re.search(r"\bASK\b", query, re.IGNORECASE) and not re.search(r"\bSELECT\b", query, re.IGNORECASE):
+            result = {"head": {}, "boolean": True}
+        else:
+            result = {"head": {"vars": []}, "results": {"bindings": []}}
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/sparql-results+json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=0):
+    """Start the stub in a background thread, returns the endpoint url."""
+    server = ThreadingHTTPServer((host, port), SparqlStubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="sparql-stub", daemon=True).start()
+    return f"http://{host}:{server.server_address[1]}/sparql"
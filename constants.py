@@ -22,3 +22,21 @@ OPERATIONS = {
 }
 
 SPARQL_TIMEOUT = int(os.environ.get('SPARQL_TIMEOUT', '300'))
+# number of threads used to talk to the triple store from within a crawl
+SPARQL_THREADPOOL_SIZE = int(os.environ.get('SPARQL_THREADPOOL_SIZE', '4'))
+# connections to the triple store kept open per process
+SPARQL_POOL_SIZE = int(os.environ.get('SPARQL_POOL_SIZE', '10'))
+# triplestore writes from a crawl are grouped: a batch is written once it holds
+# SPARQL_BATCH_SIZE entries or every SPARQL_BATCH_INTERVAL milliseconds
+SPARQL_BATCH_SIZE = int(os.environ.get('SPARQL_BATCH_SIZE', '50'))
+SPARQL_BATCH_INTERVAL = int(os.environ.get('SPARQL_BATCH_INTERVAL', '2000'))
+SPARQL_BATCH_RETRIES = int(os.environ.get('SPARQL_BATCH_RETRIES', '3'))
+# failed updates are retried after an exponential backoff with jitter (seconds)
+SPARQL_UPDATE_RETRIES = int(os.environ.get('SPARQL_UPDATE_RETRIES', '5'))
+SPARQL_RETRY_BASE_DELAY = float(os.environ.get('SPARQL_RETRY_BASE_DELAY', '1'))
+SPARQL_RETRY_MAX_DELAY = float(os.environ.get('SPARQL_RETRY_MAX_DELAY', '60'))
+# after this many failures in a row no updates are sent for SPARQL_CIRCUIT_RESET seconds
+SPARQL_CIRCUIT_FAILURES = int(os.environ.get('SPARQL_CIRCUIT_FAILURES', '5'))
+SPARQL_CIRCUIT_RESET = float(os.environ.get('SPARQL_CIRCUIT_RESET', '30'))
+# batches of a crawl that couldn't be written are kept here and written later
+SPARQL_SPILL_PATH = os.environ.get('SPARQL_SPILL_PATH', '/share/sparql-spill')
@@ -0,0 +1,42 @@
+import os
+import shutil
+
+from .file import STORAGE_PATH
+
+# keep a checkpoint (scrapy JOBDIR: pending requests, seen requests, spider state) of every crawl
+# in its job folder, so crawls stopped by a restart of the service continue where they stopped
+RESUMABLE_CRAWLS = os.getenv("RESUMABLE_CRAWLS", "true") in ["yes", "on", "true", True, "1", 1]
+RESUMABLE_MARKER = "resumable"
+
+
+def checkpoint_dir(job_id):
+    return os.path.join(STORAGE_PATH, job_id, "checkpoint")
+
+
+def crawl_settings(settings, job_id):
+    """Settings for the crawl of job_id, checkpointed in its job folder when crawls are resumable"""
+    if not RESUMABLE_CRAWLS:
+        return settings
+    settings = settings.copy()
+    settings.set("JOBDIR", checkpoint_dir(job_id))
+    return settings
+
+
+def is_resumable(job_id):
+    """
+    A checkpoint is only complete when the crawl was stopped gracefully (see lblod.extensions.Checkpoint),
+    after a crash the pending requests on disk don't match the seen requests.
+    """
+    return RESUMABLE_CRAWLS and os.path.exists(os.path.join(checkpoint_dir(job_id), RESUMABLE_MARKER))
+
+
+def set_resumable(job_id, resumable):
+    path = os.path.join(checkpoint_dir(job_id), RESUMABLE_MARKER)
+    if resumable:
+        open(path, "w").close()
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def remove_checkpoint(job_id):
+    shutil.rmtree(checkpoint_dir(job_id), ignore_errors=True)
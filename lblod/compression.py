@@ -0,0 +1,59 @@
+import gzip
+import os
+
+try:
+    import zstandard
+except ImportError:
+    # optional, only needed for FILE_COMPRESSION=zstd
+    zstandard = None
+
+# codec used for harvested pages: gzip, zstd or none
+FILE_COMPRESSION = os.getenv("FILE_COMPRESSION", "gzip")
+FILE_COMPRESSION_LEVEL = os.getenv("FILE_COMPRESSION_LEVEL")
+
+CODECS = {
+    # name: (file suffix, format, default level)
+    "gzip": (".gz", "application/gzip", 6),
+    "zstd": (".zst", "application/zstd", 3),
+    "none": ("", "text/html", None)
+}
+
+
+class Codec:
+    def __init__(self, name=FILE_COMPRESSION, level=FILE_COMPRESSION_LEVEL):
+        if name not in CODECS:
+            raise ValueError(f"unknown FILE_COMPRESSION {name}, expected one of {', '.join(CODECS)}")
+        if name == "zstd" and zstandard is None:
+            raise ValueError("FILE_COMPRESSION=zstd requires the zstandard package")
+        self.name = name
+        self.suffix, self.format, default_level = CODECS[name]
+        self.level = int(level) if level else default_level
+
+    def compress(self, data):
+        if self.name == "gzip":
+            # mtime=0 so identical pages compress to identical files
+            return gzip.compress(data, compresslevel=self.level, mtime=0)
+        if self.name == "zstd":
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return data
+
+
+def file_format(path):
+    """Format of a stored page, the codec follows from the file name."""
+    for suffix, format, _ in CODECS.values():
+        if suffix and path.endswith(suffix):
+            return format
+    return CODECS["none"][1]
+
+
+def read_file(path):
+    """Returns the uncompressed contents of a stored page, the codec follows from the file name."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".gz"):
+        return gzip.decompress(data)
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError(f"reading {path} requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
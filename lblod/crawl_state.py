@@ -0,0 +1,206 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+
+from helpers import logger
+from .file import STORAGE_PATH
+from .harvester import get_scheduled_job, get_previous_pages
+
+CRAWL_STATE_PATH = os.path.join(STORAGE_PATH, "crawl-state")
+
+FIELDS = [
+    "url",
+    "etag",
+    "last_modified",
+    "content_type",
+    "content_hash",
+    "doc_type",
+    "physical_file_path",
+    "physical_file_uuid",
+    "size",
+    "file_created",
+    "fetched_at",
+    "job_id"
+]
+
+GENERAL_PAGE_TYPE = "http://schema.org/WebPage"
+# doc type for urls imported from the triplestore, these are known not to be overview pages
+REBUILT_PAGE_TYPE = "http://xmlns.com/foaf/0.1/Document"
+REBUILT_JOB_ID = "triplestore"
+
+
+class CrawlState:
+    """
+    Per scheduled job record of what was fetched in earlier runs, kept in a sqlite file under /share.
+
+    For every url it holds the document type, when and by which job it was fetched, the HTTP
+    validators (ETag, Last-Modified), a hash of the contents and the physical file the contents were
+    stored in. It is updated while crawling and replaces querying the triplestore for the pages
+    harvested by previous jobs. Pages only count as harvested once their job finished successfully: job_id is
+    the last job that fetched a page, success_job_id the last one of those that succeeded.
+    """
+
+    def __init__(self, path, commit_every=100):
+        self.path = path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        # pages are looked up and recorded from the storage thread pool (see ConditionalRequestMiddleware and
+        # Pipeline.record_crawl_state), the lock keeps a commit from landing in the middle of a record
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_type TEXT,
+                content_hash TEXT,
+                doc_type TEXT,
+                physical_file_path TEXT,
+                physical_file_uuid TEXT,
+                size INTEGER,
+                file_created TEXT,
+                fetched_at TEXT,
+                job_id TEXT,
+                success_job_id TEXT
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT,
+                modified TEXT
+            )
+        """)
+        # requests left when the last run stopped early (see lblod.extensions.CrawlBudget)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS frontier (
+                url TEXT PRIMARY KEY,
+                priority INTEGER
+            )
+        """)
+        # added later, crawl states of earlier versions don't have it yet
+        columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(pages)")}
+        if "content_type" not in columns:
+            self.connection.execute("ALTER TABLE pages ADD COLUMN content_type TEXT")
+        if "success_job_id" not in columns:
+            self.connection.execute("ALTER TABLE pages ADD COLUMN success_job_id TEXT")
+            self.connection.execute("""
+                UPDATE pages SET success_job_id = job_id
+                WHERE job_id IN (SELECT job_id FROM jobs WHERE status = 'success')
+            """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS pages_job_id ON pages (job_id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS pages_success_job_id ON pages (success_job_id)")
+        self.connection.commit()
+
+    @classmethod
+    def for_scheduled_job(cls, scheduled_job):
+        os.makedirs(CRAWL_STATE_PATH, exist_ok=True)
+        name = hashlib.sha1(scheduled_job.encode()).hexdigest()
+        path = os.path.join(CRAWL_STATE_PATH, f"{name}.sqlite")
+        logger.info(f"using crawl state {path} for scheduled job {scheduled_job}")
+        return cls(path)
+
+    def get(self, url):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+        return dict(row) if row else None
+
+    def record(self, url, **fields):
+        """Store what we know about url, fields that aren't given keep their previous value."""
+        fields["url"] = url
+        fields.setdefault("fetched_at", datetime.datetime.now().isoformat())
+        columns = [field for field in FIELDS if field in fields]
+        with self.lock:
+            self.connection.execute(
+                f"""INSERT INTO pages ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})
+                    ON CONFLICT(url) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in columns if c != "url")}""",
+                [fields[column] for column in columns]
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self.commit()
+
+    def has_jobs(self):
+        return self.connection.execute("SELECT 1 FROM jobs LIMIT 1").fetchone() is not None
+
+    def update_job(self, job_id, status):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, status, modified) VALUES (?, ?, ?)",
+                (job_id, status, datetime.datetime.now().isoformat())
+            )
+            if status == "success":
+                self.connection.execute("UPDATE pages SET success_job_id = job_id WHERE job_id = ?", (job_id,))
+            self.commit()
+
+    def previous_pages(self, max_age_in_days = 30):
+        """
+        Generate (url, fetched_at) of the documents (not overview pages) harvested by successful jobs of
+        the last max_age_in_days, fetched_at is None for pages imported from the triplestore
+        """
+        since = (datetime.datetime.now() - datetime.timedelta(days=max_age_in_days)).isoformat()
+        rows = self.connection.execute("""
+            SELECT pages.url, pages.fetched_at FROM pages JOIN jobs ON pages.success_job_id = jobs.job_id
+            WHERE jobs.status = 'success' AND jobs.modified > ? AND pages.doc_type != ?
+        """, (since, GENERAL_PAGE_TYPE))
+        for row in rows:
+            yield row[0], row[1]
+
+    def run_number(self):
+        """Number of runs of the scheduled job recorded so far, including the current one"""
+        return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE job_id != ?", (REBUILT_JOB_ID,)).fetchone()[0]
+
+    def frontier(self):
+        """(url, priority) of the requests the last run didn't get to"""
+        return [tuple(row) for row in self.connection.execute("SELECT url, priority FROM frontier ORDER BY priority DESC")]
+
+    def set_frontier(self, requests):
+        """Replace the requests to continue with next run by (url, priority) pairs"""
+        with self.lock:
+            self.connection.execute("DELETE FROM frontier")
+            self.connection.executemany("INSERT OR IGNORE INTO frontier (url, priority) VALUES (?, ?)", requests)
+            self.commit()
+
+    def rebuild_from_triplestore(self, task_uri):
+        """(Re)import the pages harvested by previous successful jobs from the triplestore"""
+        self.connection.execute("DELETE FROM pages WHERE job_id = ?", (REBUILT_JOB_ID,))
+        count = 0
+        # streamed page by page from the triplestore
+        for url in get_previous_pages(task_uri):
+            self.connection.execute(
+                "INSERT OR IGNORE INTO pages (url, doc_type, job_id) VALUES (?, ?, ?)",
+                (url, REBUILT_PAGE_TYPE, REBUILT_JOB_ID)
+            )
+            count += 1
+        self.update_job(REBUILT_JOB_ID, "success")
+        logger.info(f"imported {count} previously harvested urls from the triplestore in {self.path}")
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    # python -m lblod.crawl_state rebuild <task uri>
+    if len(sys.argv) != 3 or sys.argv[1] != "rebuild":
+        print("usage: python -m lblod.crawl_state rebuild <task uri>")
+        sys.exit(1)
+    task_uri = sys.argv[2]
+    scheduled_job = get_scheduled_job(task_uri)
+    if not scheduled_job:
+        print(f"task {task_uri} wasn't created by a scheduled job, nothing to rebuild")
+        sys.exit(1)
+    crawl_state = CrawlState.for_scheduled_job(scheduled_job)
+    crawl_state.rebuild_from_triplestore(task_uri)
+    crawl_state.close()
@@ -0,0 +1,18 @@
+import os
+
+from scrapy.dupefilters import RFPDupeFilter
+
+from .url_set import new_url_set
+
+
+class CompactDupeFilter(RFPDupeFilter):
+    """Scrapy's request fingerprint dupe filter, keeping the seen fingerprints in a compact url set"""
+
+    def __init__(self, path=None, debug=False):
+        super().__init__(None, debug)
+        self.fingerprints = new_url_set()
+        if path:
+            # same file as RFPDupeFilter, so checkpoints (JOBDIR) stay compatible
+            self.file = open(os.path.join(path, "requests.seen"), "a+")
+            self.file.seek(0)
+            self.fingerprints.update(line.rstrip() for line in self.file)
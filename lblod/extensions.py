@@ -0,0 +1,289 @@
+import os
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+from helpers import logger
+from metrics import registry, export_snapshot
+from .checkpoint import set_resumable, remove_checkpoint
+from .progress import write_progress
+
+# seconds between two exports of the metrics and progress of a crawl
+METRICS_INTERVAL = int(os.getenv("METRICS_INTERVAL", "10"))
+
+
+class Checkpoint:
+    """
+    Marks the checkpoint of a crawl (JOBDIR) as resumable when the crawl is stopped by a shutdown of
+    the service, the checkpoint of a finished crawl is removed.
+
+    Must run after scrapy's SpiderState extension, which saves the spider state when the spider closes.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get("JOBDIR"):
+            raise NotConfigured
+        extension = cls()
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        # from now on the checkpoint on disk is incomplete until the spider closes
+        set_resumable(spider.job_id, False)
+
+    def spider_closed(self, spider, reason):
+        if reason == "shutdown":
+            set_resumable(spider.job_id, True)
+            logger.info(f"crawl of job {spider.job_id} stopped by a shutdown, it will be resumed on startup")
+        else:
+            remove_checkpoint(spider.job_id)
+
+
+class MetricsExporter:
+    """
+    Keeps the metrics of a running crawl up to date and exports the metrics of the crawler process every
+    METRICS_INTERVAL seconds, the web process serves them on /metrics (see metrics.collect).
+    """
+
+    # crawl stat: counter it is added to
+    COUNTED_STATS = {
+        "response_received_count": "scraper_pages_fetched_total",
+        "item_scraped_count": "scraper_items_stored_total",
+        "retry/count": "scraper_retries_total"
+    }
+
+    def __init__(self, crawler, interval):
+        self.crawler = crawler
+        self.interval = interval
+        self.counted = {}
+        self.loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawler, METRICS_INTERVAL)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        return extension
+
+    def spider_opened(self, spider):
+        self.last_report = (time.time(), 0)
+        self.loop = task.LoopingCall(self.report, spider)
+        self.loop.start(self.interval)
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            registry.observe("scraper_response_latency_seconds", latency)
+
+    def report(self, spider):
+        stats = self.crawler.stats
+        for stat, counter in self.COUNTED_STATS.items():
+            value = stats.get_value(stat, 0)
+            registry.inc(counter, value - self.counted.get(stat, 0))
+            self.counted[stat] = value
+        now = time.time()
+        pages = stats.get_value("response_received_count", 0)
+        last_time, last_pages = self.last_report
+        self.last_report = (now, pages)
+        slot = self.crawler.engine.scraper.slot if self.crawler.engine else None
+        registry.set("scraper_job_pages_per_second", (pages - last_pages) / max(now - last_time, 0.001), job_id=spider.job_id)
+        registry.set("scraper_job_pages_total", pages, job_id=spider.job_id)
+        registry.set("scraper_job_items_total", stats.get_value("item_scraped_count", 0), job_id=spider.job_id)
+        registry.set("scraper_job_pipeline_queue_depth", len(slot.active) if slot else 0, job_id=spider.job_id)
+        registry.set("scraper_job_triplestore_buffered", stats.get_value("triplestore/buffered", 0), job_id=spider.job_id)
+        export_snapshot()
+
+    def spider_closed(self, spider):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        self.report(spider)
+        registry.remove(job_id=spider.job_id)
+        export_snapshot()
+
+
+class ProgressReporter:
+    """
+    Writes the progress of a crawl to progress.json in its job folder every METRICS_INTERVAL seconds,
+    served by the web process on /jobs/<job id>.
+
+    The totals of a crawl (start time, pages fetched, items stored) are kept in the spider state, so a
+    resumed crawl continues counting from where it stopped. Must run after scrapy's SpiderState extension.
+    """
+
+    def __init__(self, crawler, interval):
+        self.crawler = crawler
+        self.interval = interval
+        self.loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawler, METRICS_INTERVAL)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        # SpiderState saves the spider state before spider_closed gets here, keep it up to date instead
+        crawler.signals.connect(extension.update_totals, signal=signals.response_received)
+        crawler.signals.connect(extension.update_totals, signal=signals.item_scraped)
+        return extension
+
+    def spider_opened(self, spider):
+        # spider.state only exists when the crawl keeps a checkpoint
+        state = getattr(spider, "state", {})
+        self.totals = state.setdefault("progress", {"started": time.time(), "pages_fetched": 0, "items_stored": 0})
+        # counted before the crawl was resumed
+        self.resumed = dict(self.totals)
+        self.started = self.totals["started"]
+        self.last_report = (time.time(), self.totals["pages_fetched"])
+        self.loop = task.LoopingCall(self.report, spider)
+        self.loop.start(self.interval)
+
+    def update_totals(self):
+        stats = self.crawler.stats
+        self.totals["pages_fetched"] = self.resumed["pages_fetched"] + stats.get_value("response_received_count", 0)
+        self.totals["items_stored"] = self.resumed["items_stored"] + stats.get_value("item_scraped_count", 0)
+
+    def report(self, spider, status="running", reason=None):
+        stats = self.crawler.stats
+        now = time.time()
+        self.update_totals()
+        pages = self.totals["pages_fetched"]
+        last_time, last_pages = self.last_report
+        self.last_report = (now, pages)
+        rate = (pages - last_pages) / max(now - last_time, 0.001)
+        slot = self.crawler.engine.slot if self.crawler.engine else None
+        queued = len(slot.scheduler) if slot else 0
+        write_progress(spider.job_id, {
+            "job_id": spider.job_id,
+            "task": spider.task,
+            "status": status,
+            "finish_reason": reason,
+            "started": self.started,
+            "updated": now,
+            "elapsed_seconds": now - self.started,
+            "pages_fetched": pages,
+            "items_stored": self.totals["items_stored"],
+            "requests_queued": queued,
+            "requests_in_progress": len(self.crawler.engine.downloader.active) if slot else 0,
+            "errors": {
+                "failed_urls": len(getattr(spider, "state", {}).get("failed_urls", [])) + len(spider.failed_urls),
+                "http_errors": sum(value for key, value in stats.get_stats().items()
+                                   if key.startswith("downloader/response_status_count/") and key[-3:] >= "400"),
+                "download_exceptions": stats.get_value("downloader/exception_count", 0),
+                "spider_exceptions": sum(value for key, value in stats.get_stats().items() if key.startswith("spider_exceptions/")),
+                "triplestore_batch_failures": stats.get_value("triplestore/batch_failures", 0),
+                "triplestore_spilled_batches": stats.get_value("triplestore/spilled_batches", 0)
+            },
+            "pages_per_second": rate,
+            "average_pages_per_second": pages / max(now - self.started, 0.001),
+            # only counts the requests that are known now, pages found later add to it
+            "eta_seconds": queued / rate if status == "running" and rate > 0 else None
+        })
+
+    def spider_closed(self, spider, reason):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        self.report(spider, "suspended" if reason == "shutdown" else "finished", reason)
+
+
+class CrawlBudget:
+    """
+    Closes a crawl when it ran out of one of its budgets: wall-clock seconds, bytes downloaded or batches
+    written (or attempted) to the triplestore. Defaults come from the CRAWL_BUDGET_* settings, a job can set its own with
+    the spider arguments budget_seconds, budget_bytes and budget_sparql_writes (0 is unlimited).
+
+    The requests still waiting in the scheduler are taken out and kept on the spider (pending_requests),
+    the pipeline records them so the next run of a scheduled job continues where this one stopped. The
+    requests in progress finish and the crawl closes normally, the links they yield are kept as well.
+    """
+
+    # budget: (setting, crawl stat it limits)
+    BUDGETS = {
+        "seconds": ("CRAWL_BUDGET_SECONDS", None),
+        "bytes": ("CRAWL_BUDGET_BYTES", "downloader/response_bytes"),
+        # batches that failed or were spilled count as well, or a crawl would never stop while the triplestore is down
+        "sparql_writes": ("CRAWL_BUDGET_SPARQL_WRITES", "triplestore/batches_attempted"),
+    }
+
+    def __init__(self, crawler, interval=1):
+        self.crawler = crawler
+        self.interval = interval
+        self.budgets = {}
+        self.loop = None
+        self.exceeded = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawler)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        crawler.signals.connect(extension.request_scheduled, signal=signals.request_scheduled)
+        return extension
+
+    def spider_opened(self, spider):
+        self.budgets = {}
+        for budget, (setting, _) in self.BUDGETS.items():
+            # a job can lift a default budget with 0
+            limit = getattr(spider, f"budget_{budget}", None)
+            limit = float(limit if limit is not None else self.crawler.settings.getfloat(setting))
+            if limit > 0:
+                self.budgets[budget] = limit
+        if not self.budgets:
+            return
+        logger.info(f"crawl of job {spider.job_id} has budgets {self.budgets}")
+        self.started = time.time()
+        self.loop = task.LoopingCall(self.check, spider)
+        self.loop.start(self.interval)
+
+    def response_received(self, response, request, spider):
+        if self.budgets:
+            self.check(spider)
+
+    def request_scheduled(self, request, spider):
+        if not self.exceeded:
+            return
+        # yielded by a response that was still in progress, the closing engine won't fetch it anymore.
+        # Asking the dupe filter first also makes the scheduler drop it as a duplicate of itself
+        if request.dont_filter or not self.crawler.engine.slot.scheduler.df.request_seen(request):
+            spider.pending_requests.append((request.url, request.priority))
+            self.crawler.stats.inc_value("budget/pending_requests")
+
+    def used(self, budget):
+        _, stat = self.BUDGETS[budget]
+        if stat is None:
+            return time.time() - self.started
+        return self.crawler.stats.get_value(stat, 0)
+
+    def check(self, spider):
+        if self.exceeded:
+            return
+        for budget, limit in self.budgets.items():
+            if self.used(budget) >= limit:
+                self.exceeded = budget
+                self.stop(spider, budget, limit)
+                return
+
+    def stop(self, spider, budget, limit):
+        scheduler = self.crawler.engine.slot.scheduler
+        pending = []
+        # stop taking new requests, the scheduler is emptied before the engine asks for the next one
+        while scheduler.has_pending_requests():
+            request = scheduler.next_request()
+            if request is None:
+                break
+            pending.append((request.url, request.priority))
+        spider.pending_requests = pending
+        logger.info(f"crawl of job {spider.job_id} used its {budget} budget ({limit:g}), "
+                    f"finishing the {len(self.crawler.engine.downloader.active)} requests in progress, "
+                    f"{len(pending)} requests left for the next run")
+        self.crawler.stats.set_value("budget/exceeded", budget)
+        self.crawler.stats.set_value("budget/pending_requests", len(pending))
+        self.crawler.engine.close_spider(spider, f"budget_{budget}")
+
+    def spider_closed(self, spider):
+        if self.loop and self.loop.running:
+            self.loop.stop()
@@ -0,0 +1,68 @@
+import sys
+
+from lxml import etree
+
+from lblod.compression import read_file
+
+
+class _AnnotationCollector:
+    """lxml parser target collecting typeof values and annotated links, without building a tree"""
+
+    def __init__(self):
+        self.type_ofs = []
+        self.links = []
+
+    def start(self, tag, attrib):
+        type_of = attrib.get("typeof")
+        if type_of is not None:
+            self.type_ofs.append(type_of)
+        if tag == "a":
+            href = attrib.get("href")
+            property_value = attrib.get("property")
+            if href is not None and property_value is not None:
+                self.links.append((href, property_value))
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return self.type_ofs, self.links
+
+
+def extract_annotations(text):
+    """
+    Single pass over an html document returning the values of all typeof attributes and the (href, property)
+    of all links having both, in document order. Same result as `//@typeof` and `//a[@href and @property]`
+    on a scrapy selector, the text is prepared and parsed with the same lxml parser settings.
+    """
+    body = text.strip().replace("\x00", "").encode("utf8") or b"<html/>"
+    parser = etree.HTMLParser(target=_AnnotationCollector(), recover=True, encoding="utf8", huge_tree=True)
+    return etree.fromstring(body, parser=parser)
+
+
+def _xpath_annotations(text):
+    """The previous, selector based, extraction. Used to validate extract_annotations."""
+    from parsel import Selector
+    selector = Selector(text=text)
+    type_ofs = selector.xpath('//@typeof').getall()
+    links = [(element.xpath('@href').get(), element.xpath('@property').get()) for element in selector.xpath('//a[@href and @property]')]
+    return type_ofs, links
+
+
+if __name__ == "__main__":
+    # python -m lblod.extractor <page.html[.gz|.zst]>...
+    # checks the extractor against the selector based extraction on saved pages
+    mismatches = 0
+    for path in sys.argv[1:]:
+        text = read_file(path).decode("utf8", errors="replace")
+        if extract_annotations(text) != _xpath_annotations(text):
+            mismatches += 1
+            print(f"MISMATCH {path}")
+    print(f"checked {len(sys.argv) - 1} pages, {mismatches} mismatches")
+    sys.exit(1 if mismatches else 0)
@@ -10,12 +10,12 @@ STORAGE_PATH = f"/share/"
 ############################################################
 
 
-def construct_insert_file_query(file, physical_file, graph=MU_APPLICATION_GRAPH):
+def construct_insert_files_query(files, graph=MU_APPLICATION_GRAPH):
     """
-    Construct a SPARQL query for inserting a file.
+    Construct a single SPARQL query inserting several files at once.
 
-    :param file: dict containing properties for file
-    :param share_uri:
+    :param files: list of (file, physical_file) tuples, file has the keys remote_data_object, mimetype,
+        created, size, extension and doc_type, physical_file has uri, uuid and name
     :returns: string containing SPARQL query
     """
     query_template = Template("""
@@ -29,50 +29,55 @@ PREFIX    adms: <http://www.w3.org/ns/adms#>
 
 DELETE {
     GRAPH $graph {
-      $data_source_uri adms:status ?status.
-      $data_source_uri dct:modified ?modified .
+      ?dataSource adms:status ?status.
+      ?dataSource dct:modified ?modified .
     }
 }
 INSERT  {
     GRAPH $graph {
-        $physical_uri a nfo:FileDataObject ;
-            mu:uuid $physical_uuid ;
-            nfo:fileName $physical_name ;
-            nie:dataSource $data_source_uri;
-            ndo:copiedFrom $data_source_uri;
-            dct:format $mimetype ;
-            dct:created $created ;
-            nfo:fileSize $size ;
-            dbpedia:fileExtension $extension .
-        $data_source_uri adms:status $new_status.
-        $data_source_uri dct:modified $created.
-        $data_source_uri a nfo:FileDataObject;
-                         nfo:fileName $physical_name;
-                         nfo:fileSize $size;
-                         dct:type $doc_type.
+        ?physical a nfo:FileDataObject ;
+            mu:uuid ?physicalUuid ;
+            nfo:fileName ?physicalName ;
+            nie:dataSource ?dataSource;
+            ndo:copiedFrom ?dataSource;
+            dct:format ?mimetype ;
+            dct:created ?created ;
+            nfo:fileSize ?size ;
+            dbpedia:fileExtension ?extension .
+        ?dataSource adms:status $new_status.
+        ?dataSource dct:modified ?created.
+        ?dataSource a nfo:FileDataObject;
+                         nfo:fileName ?physicalName;
+                         nfo:fileSize ?size;
+                         dct:type ?docType.
     }
 }
 WHERE {
+    VALUES (?dataSource ?physical ?physicalUuid ?physicalName ?mimetype ?created ?size ?extension ?docType) {
+        $values
+    }
     GRAPH $graph {
-      OPTIONAL { $data_source_uri adms:status ?status. }
-      $data_source_uri dct:modified ?modified.
+      OPTIONAL { ?dataSource adms:status ?status. }
+      ?dataSource dct:modified ?modified.
     }
 }
 """)
-    doc_type = file["doc_type"] if file["doc_type"] else "http://xmlns.com/foaf/0.1/Document"
+    values = []
+    for file, physical_file in files:
+        doc_type = file["doc_type"] if file["doc_type"] else "http://xmlns.com/foaf/0.1/Document"
+        values.append("({} {} {} {} {} {} {} {} {})".format(
+            sparql_escape_uri(file["remote_data_object"]),
+            sparql_escape_uri(physical_file["uri"]),
+            sparql_escape_string(physical_file["uuid"]),
+            sparql_escape_string(physical_file["name"]),
+            sparql_escape_string(file["mimetype"]),
+            sparql_escape_datetime(file["created"]),
+            sparql_escape_int(file["size"]),
+            sparql_escape_string(file["extension"]),
+            sparql_escape_uri(doc_type)
+        ))
     return query_template.substitute(
         graph=sparql_escape_uri(graph),
-        name=sparql_escape_string(file["name"]),
-        mimetype=sparql_escape_string(file["mimetype"]),
-        created=sparql_escape_datetime(file["created"]),
-        size=sparql_escape_int(file["size"]),
-        extension=sparql_escape_string(file["extension"]),
-        physical_uri=sparql_escape_uri(physical_file["uri"]),
-        physical_uuid=sparql_escape_string(physical_file["uuid"]),
-        physical_name=sparql_escape_string(physical_file["name"]),
-        data_source_uri=sparql_escape_uri(file["remote_data_object"]),
         new_status=sparql_escape_uri(FILE_STATUSES["COLLECTED"]),
-        doc_type=sparql_escape_uri(doc_type)
+        values="\n        ".join(values)
     )
-
-
@@ -0,0 +1,45 @@
+import os
+import re
+from datetime import date
+
+
+def _parse_link_priorities():
+    raw = os.getenv(
+        "LINK_PRIORITIES",
+        "linkToPublication:30,heeftNotulen:30,heeftBesluitenlijst:30,heeftUittreksel:20,heeftAgenda:20"
+    )
+    priorities = []
+    for entry in raw.split(","):
+        if entry.strip():
+            prop, _, priority = entry.partition(":")
+            priorities.append((prop.strip(), int(priority or 0)))
+    return priorities
+
+
+# property of a link: priority of the request following it, links matching none of them get 0
+LINK_PRIORITIES = _parse_link_priorities()
+# priority added for links mentioning the current year, one point less for every year before
+RECENCY_PRIORITY = int(os.getenv("RECENCY_PRIORITY", "10"))
+
+# a year (1990-2099) in the url, e.g. /zittingen/2024-03-12/ or ?jaar=2023
+YEAR_PATTERN = re.compile(r"(?<!\d)(199\d|20\d\d)(?!\d)")
+
+
+def recency_priority(url, today=None):
+    """Priority of the most recent year in the url, documents of recent meetings come first"""
+    years = [int(year) for year in YEAR_PATTERN.findall(url)]
+    current_year = (today or date.today()).year
+    years = [year for year in years if year <= current_year]
+    if not years:
+        return 0
+    return max(0, RECENCY_PRIORITY - (current_year - max(years)))
+
+
+def link_priority(url, property_value):
+    """
+    Scheduling priority of a link: documents (notulen, besluitenlijsten, publications) before overview
+    pages, recent before old, so crawls that are cut short (CLOSESPIDER_ITEMCOUNT, budgets) still
+    collected the most useful pages.
+    """
+    priority = max((priority for prop, priority in LINK_PRIORITIES if prop in property_value), default=0)
+    return priority + recency_priority(url)
@@ -2,23 +2,15 @@ from string import Template
 
 from escape_helpers import sparql_escape_uri, sparql_escape_string, sparql_escape_datetime, sparql_escape_int
 from helpers import logger, generate_uuid
-from sudo_query import update_sudo, query_sudo
+from sudo_query import query_sudo
 import uuid
 import datetime
 import re
 from urllib.parse import urldefrag
-import random
 
 
 from constants import DEFAULT_GRAPH, RESOURCE_BASE, FILE_STATUSES
 
-def ensure_remote_data_object(collection, url):
-    rdo = get_remote_data_object(collection, url)
-    if rdo:
-        return rdo
-    else:
-        return create_remote_data_object(collection, url)
-
 def clean_url(url):
     """
     Workaround to avoid extracting the same url multiple times because a `jsessionid`
@@ -31,7 +23,18 @@ def clean_url(url):
     url = re.sub(";jsessionid=[a-zA-Z;0-9]*", "", url)
     return re.sub(r'/\(S\([^)]+\)\)', '', url) # e.g : ranst https://ranst.meetingburger.net/(S(qp4fgo00jjm2islntouxtevs))/cbs/5272f4f2-4c69-45b1-8d59-3a314680c30f/besluitenlijs
 
-def create_remote_data_object(collection, url):
+def new_remote_data_object(url):
+    """Mint a remote data object for url, it still has to be written with construct_insert_remote_data_objects_query"""
+    uuid = generate_uuid()
+    return {
+        'uuid': uuid,
+        'url': url,
+        'uri': RESOURCE_BASE.rstrip("/") + f"/remote-data-objects/{uuid}",
+        'status': FILE_STATUSES['READY'],
+        'created': datetime.datetime.now()
+    }
+
+def construct_insert_remote_data_objects_query(collection, rdos):
     query_template = Template("""
     PREFIX    adms: <http://www.w3.org/ns/adms#>
     PREFIX    mu: <http://mu.semte.ch/vocabularies/core/>
@@ -42,6 +45,11 @@ def create_remote_data_object(collection, url):
 
     INSERT DATA {
       GRAPH $graph {
+        $rdos
+      }
+    }
+""")
+    rdo_template = Template("""
         $collection dct:hasPart $uri.
         $uri a nfo:RemoteDataObject .
         $uri mu:uuid $uuid;
@@ -49,31 +57,61 @@ def create_remote_data_object(collection, url):
              dct:created $created;
              dct:creator <http://lblod.data.gift/services/scraper>;
              dct:modified $modified;
-             adms:status $status.
-      }
-    }
-""")
-    uuid = generate_uuid()
-    uri = RESOURCE_BASE.rstrip("/") + f"/remote-data-objects/{uuid}"
-    created = datetime.datetime.now()
-    q_string = query_template.substitute(
+             adms:status $status.""")
+    rdos_string = "".join(
+        rdo_template.substitute(
+            uri = sparql_escape_uri(rdo["uri"]),
+            uuid = sparql_escape_string(rdo["uuid"]),
+            url = sparql_escape_uri(clean_url(rdo["url"])),
+            status = sparql_escape_uri(rdo["status"]),
+            created = sparql_escape_datetime(rdo["created"]),
+            modified = sparql_escape_datetime(rdo["created"]),
+            collection = sparql_escape_uri(collection)
+        ) for rdo in rdos
+    )
+    return query_template.substitute(
         graph = sparql_escape_uri(DEFAULT_GRAPH),
-        uri = sparql_escape_uri(uri),
-        uuid = sparql_escape_string(uuid),
-        url = sparql_escape_uri(clean_url(url)),
-        status = sparql_escape_uri(FILE_STATUSES['READY']),
-        created = sparql_escape_datetime(created),
-        modified = sparql_escape_datetime(created),
-        collection = sparql_escape_uri(collection)
-
+        rdos = rdos_string
     )
-    update_sudo(q_string)
-    return {
-        'uuid': uuid,
-        'url': url,
-        'uri': uri,
-        'status': FILE_STATUSES['READY']
-    }
+
+def get_remote_data_objects(collection_uri):
+    """Return a dict mapping the (cleaned) url of every remote data object in a collection to its URI.
+
+    Uses keyset pagination (advancing a FILTER boundary) rather than OFFSET, which
+    runs into Virtuoso's sorted-top-rows limit once the offset grows large.
+    """
+    uris = {}
+    page_size = 5000
+    last = ""
+    query_template = Template("""
+    PREFIX    nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
+    PREFIX    dct: <http://purl.org/dc/terms/>
+    PREFIX    nfo: <http://www.semanticdesktop.org/ontologies/2007/03/22/nfo#>
+    SELECT DISTINCT ?rdo ?url WHERE {
+      GRAPH $graph {
+        $collection dct:hasPart ?rdo.
+        ?rdo a nfo:RemoteDataObject;
+             nie:url ?url.
+        FILTER(STR(?rdo) > $last)
+      }
+    } ORDER BY ?rdo LIMIT $limit
+    """)
+    while True:
+        query_s = query_template.substitute(
+            graph = sparql_escape_uri(DEFAULT_GRAPH),
+            collection = sparql_escape_uri(collection_uri),
+            last = sparql_escape_string(last),
+            limit = page_size
+        )
+        results = query_sudo(query_s)
+        bindings = results["results"]["bindings"]
+        for b in bindings:
+            uris[clean_url(b["url"]["value"])] = b["rdo"]["value"]
+        if len(bindings) < page_size:
+            break
+        last = bindings[-1]["rdo"]["value"]
+    logger.info(f"loaded {len(uris)} remote data objects of collection {collection_uri}")
+    return uris
 
 def get_previous_succesfull_jobs(task_uri, max_age_in_days = 30):
     query_t = Template("""
@@ -102,83 +140,98 @@ def get_previous_succesfull_jobs(task_uri, max_age_in_days = 30):
     jobs = map(lambda b: b["olderJob"]["value"], bindings)
     return jobs
 
-def count_previous_urls(jobs):
+def get_scheduled_job(task_uri):
+    """Return the scheduled job that created the job of this task, or None for a manually created job"""
+    query_t = Template("""
+    PREFIX cogs: <http://vocab.deri.ie/cogs#>
+    PREFIX    dct: <http://purl.org/dc/terms/>
+    SELECT DISTINCT ?scheduledJob WHERE {
+      GRAPH $graph {
+         $task dct:isPartOf ?job.
+         ?job dct:creator ?scheduledJob.
+         ?scheduledJob a cogs:ScheduledJob.
+      }
+    }
+    """)
+    query_s = query_t.substitute(
+        graph = sparql_escape_uri(DEFAULT_GRAPH),
+        task = sparql_escape_uri(task_uri)
+    )
+    results = query_sudo(query_s)
+    bindings = results["results"]["bindings"]
+    if len(bindings) == 1:
+        return bindings[0]["scheduledJob"]["value"]
+    return None
+
+def get_results_containers(jobs):
+    """Results containers of the collecting tasks of jobs"""
     query_t = Template("""
         PREFIX tasks: <http://redpencil.data.gift/vocabularies/tasks/>
         PREFIX    dct: <http://purl.org/dc/terms/>
-        PREFIX    nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
-        SELECT (COUNT(DISTINCT(?url)) as ?count) WHERE {
+        SELECT DISTINCT ?container WHERE {
           GRAPH $graph {
             VALUES ?job {
               $jobs
             }
             ?task dct:isPartOf ?job;
                   tasks:operation <http://lblod.data.gift/id/jobs/concept/TaskOperation/collecting>;
-                  tasks:resultsContainer/tasks:hasFile ?file.
-            ?file nie:url ?url;
-                  dct:type ?type.
-            FILTER(?type != <http://schema.org/WebPage>)
-        }
+                  tasks:resultsContainer ?container.
+          }
         }
         """)
-
     query_s = query_t.substitute(
         graph = sparql_escape_uri(DEFAULT_GRAPH),
         jobs = "\n".join(map(lambda j: sparql_escape_uri(j), jobs)),
     )
     results = query_sudo(query_s)
-    bindings = results["results"]["bindings"]
-    count = bindings[0]["count"]["value"]
-    logger.info(f"found {count} previously harvested urls that should not be harvested again")
-    return int(count)
+    return [b["container"]["value"] for b in results["results"]["bindings"]]
 
-def get_previous_pages(task_uri):
+def get_previous_pages(task_uri, page_size=5000):
+    """
+    Generate the urls of the documents (not overview pages) harvested by the previous successful jobs of
+    the scheduled job of task_uri.
+
+    Uses keyset pagination over the urls rather than OFFSET, which runs into Virtuoso's sorted-top-rows
+    limit once the offset grows large. The results containers are looked up once, so the pages don't
+    join the jobs again.
+    """
     jobs = list(get_previous_succesfull_jobs(task_uri))
-    if len(jobs) > 0:
-        nb_urls= count_previous_urls(jobs)
-        offset = 0
-        urls = []
-        while offset < nb_urls:
-            query_t = Template("""
-            PREFIX tasks: <http://redpencil.data.gift/vocabularies/tasks/>
-            PREFIX    dct: <http://purl.org/dc/terms/>
-            PREFIX    nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
-            SELECT ?url WHERE {
-              SELECT DISTINCT ?url {
-                GRAPH $graph {
-                  VALUES ?job {
-                    $jobs
-                  }
-                  ?task dct:isPartOf ?job;
-                  tasks:operation <http://lblod.data.gift/id/jobs/concept/TaskOperation/collecting>;
-                  tasks:resultsContainer/tasks:hasFile ?file.
-                  ?file nie:url ?url;
+    if not jobs:
+        return
+    containers = get_results_containers(jobs)
+    if not containers:
+        return
+    query_t = Template("""
+        PREFIX tasks: <http://redpencil.data.gift/vocabularies/tasks/>
+        PREFIX    dct: <http://purl.org/dc/terms/>
+        PREFIX    nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
+        SELECT DISTINCT ?url WHERE {
+          GRAPH $graph {
+            VALUES ?container {
+              $containers
+            }
+            ?container tasks:hasFile ?file.
+            ?file nie:url ?url;
                   dct:type ?type.
-                  FILTER(?type != <http://schema.org/WebPage>)
-               }
-            } ORDER BY ?url
-        } LIMIT 5000 OFFSET $offset
+            FILTER(?type != <http://schema.org/WebPage>)
+            FILTER(STR(?url) > $last)
+          }
+        } ORDER BY ?url LIMIT $limit
         """)
-
-            query_s = query_t.substitute(
-                graph = sparql_escape_uri(DEFAULT_GRAPH),
-                jobs = "\n".join(map(lambda j: sparql_escape_uri(j), jobs)),
-                offset = offset
-            )
-            results = query_sudo(query_s)
-            bindings = results["results"]["bindings"]
-            for b in bindings:
-                urls.append(b["url"]["value"])
-            offset = offset + 5000
-        return urls
-    return []
-
-def remove_random_10_percent_of_list(input_list):
-    if not input_list:
-        return input_list
-    num_elements_to_remove = max(1, int(len(input_list) * 0.1))
-    elements_to_remove = random.sample(input_list, num_elements_to_remove)
-    return [item for item in input_list if item not in elements_to_remove]
+    last = ""
+    while True:
+        query_s = query_t.substitute(
+            graph = sparql_escape_uri(DEFAULT_GRAPH),
+            containers = "\n".join(map(lambda c: sparql_escape_uri(c), containers)),
+            last = sparql_escape_string(last),
+            limit = page_size
+        )
+        bindings = query_sudo(query_s)["results"]["bindings"]
+        for b in bindings:
+            yield b["url"]["value"]
+        if len(bindings) < page_size:
+            break
+        last = bindings[-1]["url"]["value"]
 
 def count_number_of_files_in_collection(collection_uri):
         query_template = Template("""
@@ -204,67 +257,47 @@ def count_number_of_files_in_collection(collection_uri):
         else:
           return 0
 
-def get_collected_data_objects(collection_uri):
-    """Return the URIs of all collected remote data objects in a collection.
+def construct_link_files_to_results_container_query(results_container, rdos):
+    """Link the remote data objects that were collected to the results container of the task"""
+    query_template = Template("""
+    PREFIX    task: <http://redpencil.data.gift/vocabularies/tasks/>
+    INSERT DATA {
+      GRAPH $graph { $result_container task:hasFile $rdos. }
+    }
+    """)
+    return query_template.substitute(
+        graph = sparql_escape_uri(DEFAULT_GRAPH),
+        result_container = sparql_escape_uri(results_container),
+        rdos = ", ".join(sparql_escape_uri(rdo) for rdo in rdos)
+    )
 
-    Uses keyset pagination (advancing a FILTER boundary) rather than OFFSET, which
-    runs into Virtuoso's sorted-top-rows limit once the offset grows large.
-    """
-    uris = []
-    page_size = 5000
-    last = ""
+def get_results_container(task_uri):
+    """Results container of a task, None if it doesn't have one yet (e.g. when a crawl is resumed)"""
     query_template = Template("""
-    PREFIX    adms: <http://www.w3.org/ns/adms#>
-    PREFIX    dct: <http://purl.org/dc/terms/>
-    SELECT DISTINCT ?rdo WHERE {
+    PREFIX    task: <http://redpencil.data.gift/vocabularies/tasks/>
+    SELECT ?container WHERE {
       GRAPH $graph {
-        $collection dct:hasPart ?rdo.
-        ?rdo adms:status $status_collected.
-        FILTER(STR(?rdo) > $last)
+        $task task:resultsContainer ?container.
       }
-    } ORDER BY ?rdo LIMIT $limit
+    } LIMIT 1
     """)
-    while True:
-        query_s = query_template.substitute(
-            graph = sparql_escape_uri(DEFAULT_GRAPH),
-            status_collected = sparql_escape_uri(FILE_STATUSES['COLLECTED']),
-            collection = sparql_escape_uri(collection_uri),
-            last = sparql_escape_string(last),
-            limit = page_size
-        )
-        results = query_sudo(query_s)
-        bindings = results["results"]["bindings"]
-        for b in bindings:
-            uris.append(b["rdo"]["value"])
-        if len(bindings) < page_size:
-            break
-        last = uris[-1]
-    return uris
+    query_s = query_template.substitute(
+        graph = sparql_escape_uri(DEFAULT_GRAPH),
+        task = sparql_escape_uri(task_uri)
+    )
+    bindings = query_sudo(query_s)["results"]["bindings"]
+    return bindings[0]["container"]["value"] if bindings else None
 
-def copy_files_to_results_container(collection_uri, results_container):
-    # Read the data objects first and link them with plain `INSERT DATA` batches;
-    # a combined `INSERT ... WHERE { SELECT ... ORDER BY ... LIMIT ... OFFSET }` runs
-    # into Virtuoso's sorted-top-rows limit on large collections.
-    rdos = get_collected_data_objects(collection_uri)
-    batch_size = 1000
-    query_template = Template("""
-    PREFIX    task: <http://redpencil.data.gift/vocabularies/tasks/>
-    INSERT DATA {
-      GRAPH $graph { $result_container task:hasFile $rdos. }
+def new_results_container():
+    """Mint a results container, it still has to be written with construct_insert_results_container_query"""
+    uuid = generate_uuid()
+    return {
+        'uuid': uuid,
+        'uri': RESOURCE_BASE.rstrip("/") + f"/data-containers/{uuid}"
     }
-    """)
-    for i in range(0, len(rdos), batch_size):
-        batch = rdos[i:i + batch_size]
-        rdos_str = ", ".join(sparql_escape_uri(rdo) for rdo in batch)
-        query_s = query_template.substitute(
-            graph = sparql_escape_uri(DEFAULT_GRAPH),
-            result_container = sparql_escape_uri(results_container),
-            rdos = rdos_str
-        )
-        update_sudo(query_s)
 
-def create_results_container(task_uri, collection_uri):
-    create_container_query = Template("""
+def construct_insert_results_container_query(task_uri, container):
+    query_template = Template("""
     PREFIX    adms: <http://www.w3.org/ns/adms#>
     PREFIX    mu: <http://mu.semte.ch/vocabularies/core/>
     PREFIX    nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
@@ -279,80 +312,56 @@ def create_results_container(task_uri, collection_uri):
       }
     }
     """)
-    uuid = generate_uuid()
-    uri = RESOURCE_BASE.rstrip("/") + f"/data-containers/{uuid}"
-    query_s = create_container_query.substitute(
+    return query_template.substitute(
         graph = sparql_escape_uri(DEFAULT_GRAPH),
-        result_container = sparql_escape_uri(uri),
-        uuid = sparql_escape_string(uuid),
+        result_container = sparql_escape_uri(container["uri"]),
+        uuid = sparql_escape_string(container["uuid"]),
         task = sparql_escape_uri(task_uri)
     )
-    update_sudo(query_s)
-    return uri
 
-"""
-get remote data object in a harvesting collection that matches remote url. Expects 1 RDO
-"""
-def get_remote_data_object(collection_uri, remote_url):
+def get_harvest_collections_for_tasks(task_uris, graph = DEFAULT_GRAPH):
+    """Harvesting collection of several tasks in one query, returns a dict of task uri to collection uri"""
     query_template = Template("""
-    PREFIX    adms: <http://www.w3.org/ns/adms#>
-    PREFIX    mu: <http://mu.semte.ch/vocabularies/core/>
-    PREFIX    nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
-    PREFIX    dct: <http://purl.org/dc/terms/>
-    PREFIX    nfo: <http://www.semanticdesktop.org/ontologies/2007/03/22/nfo#>
-    PREFIX    nuao: <http://www.semanticdesktop.org/ontologies/2010/01/25/nuao#>
-
-    SELECT DISTINCT ?dataObject ?uuid ?status
+    PREFIX tasks: <http://redpencil.data.gift/vocabularies/tasks/>
+    SELECT ?task ?collection
     WHERE {
-      GRAPH $graph {
-        $collection dct:hasPart ?dataObject.
-        ?dataObject a nfo:RemoteDataObject;
-             mu:uuid ?uuid;
-             nie:url $url.
-        OPTIONAL { ?dataObject adms:status ?status.}
+      GRAPH $graph  {
+        VALUES ?task {
+          $tasks
+        }
+        ?task tasks:inputContainer ?inputContainer.
+        ?inputContainer tasks:hasHarvestingCollection ?collection.
       }
     }
-""")
-    query_string = query_template.substitute(
-        graph = sparql_escape_uri(DEFAULT_GRAPH),
-        collection = sparql_escape_uri(collection_uri),
-        url = sparql_escape_uri(clean_url(remote_url))
+    """)
+    query_s = query_template.substitute(
+        graph = sparql_escape_uri(graph),
+        tasks = "\n".join(sparql_escape_uri(task) for task in task_uris)
     )
-    results = query_sudo(query_string)
-    bindings = results["results"]["bindings"]
-    if len(bindings) == 1:
-        item = bindings[0]
-        uuid = item['uuid']['value']
-        uri = item['dataObject']['value']
-        status = item.get('status', {}).get('value', None)
-        return {
-            'uuid': uuid,
-            'url': remote_url,
-            'uri': uri,
-            'status': status
-        }
-    elif len(bindings) == 0:
-        return None
-    else:
-        raise Exception(f"Unexpected result {results}")
-
+    collections = {}
+    for b in query_sudo(query_s)["results"]["bindings"]:
+        collections.setdefault(b["task"]["value"], []).append(b["collection"]["value"])
+    # a task is expected to have exactly one collection
+    return {task: uris[0] for task, uris in collections.items() if len(uris) == 1}
 
-"""
-get remote data object in a harvesting collection. Expects 1 RDO
-"""
-def get_initial_remote_data_object(collection_uri):
+def get_initial_remote_data_objects(collection_uris):
+    """
+    Remote data object of several harvesting collections in one query, returns a dict of collection
+    uri to remote data object (uuid, url, uri). Collections with more than one are left out.
+    """
     query_template = Template("""
-    PREFIX    adms: <http://www.w3.org/ns/adms#>
     PREFIX    mu: <http://mu.semte.ch/vocabularies/core/>
     PREFIX    nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
     PREFIX    dct: <http://purl.org/dc/terms/>
     PREFIX    nfo: <http://www.semanticdesktop.org/ontologies/2007/03/22/nfo#>
-    PREFIX    nuao: <http://www.semanticdesktop.org/ontologies/2010/01/25/nuao#>
 
-    SELECT DISTINCT ?dataObject ?url ?uuid ?status
+    SELECT DISTINCT ?collection ?dataObject ?url ?uuid
     WHERE {
       GRAPH $graph {
-        $collection dct:hasPart ?dataObject.
+        VALUES ?collection {
+          $collections
+        }
+        ?collection dct:hasPart ?dataObject.
         ?dataObject a nfo:RemoteDataObject;
              mu:uuid ?uuid;
              nie:url ?url.
@@ -361,45 +370,16 @@ def get_initial_remote_data_object(collection_uri):
 """)
     query_string = query_template.substitute(
         graph = sparql_escape_uri(DEFAULT_GRAPH),
-        collection = sparql_escape_uri(collection_uri)
-    )
-    results = query_sudo(query_string)
-    bindings = results["results"]["bindings"]
-    if len(bindings) == 1:
-        item = bindings[0]
-        uuid = item['uuid']['value']
-        url = item['url']['value']
-        uri = item['dataObject']['value']
-        return {
-            'uuid': uuid,
-            'url': url,
-            'uri': uri
-        }
-    else:
-        raise Exception(f"Unexpected result {results}")
-
-def get_harvest_collection_for_task(task, graph = DEFAULT_GRAPH):
-    task_uri = task["uri"]
-    query_template = Template("""
-    PREFIX tasks: <http://redpencil.data.gift/vocabularies/tasks/>
-    SELECT ?collection
-    WHERE {
-      GRAPH $graph  {
-        $task tasks:inputContainer ?inputContainer.
-        ?inputContainer tasks:hasHarvestingCollection ?collection.
-      }
-    }
-    """)
-    query_s = query_template.substitute(
-        graph = sparql_escape_uri(graph),
-        task = sparql_escape_uri(task_uri)
+        collections = "\n".join(sparql_escape_uri(collection) for collection in collection_uris)
     )
-    results = query_sudo(query_s)
-    bindings = results["results"]["bindings"]
-    if (len(bindings) == 1):
-        return bindings[0]["collection"]["value"]
-    else:
-        raise Exception(f"Unexpected result {results}")
+    rdos = {}
+    for item in query_sudo(query_string)["results"]["bindings"]:
+        rdos.setdefault(item["collection"]["value"], []).append({
+            'uuid': item['uuid']['value'],
+            'url': item['url']['value'],
+            'uri': item['dataObject']['value']
+        })
+    return {collection: found[0] for collection, found in rdos.items() if len(found) == 1}
 
 
 def collection_has_collected_files(collection):
@@ -419,13 +399,14 @@ def collection_has_collected_files(collection):
     result = query_sudo(query_s)
     return result["boolean"]
 
-def store_report_metadata(physical_file_path, physical_file_name, results_container, size):
+def construct_insert_report_query(physical_file_path, physical_file_name, results_container, size):
+        """Link the report of a crawl to the results container of its task"""
         physical_resource_uri = physical_file_path.replace("/share/", "share://")
         physical_resource_uuid = str(uuid.uuid4())
         virtual_resource_uuid = str(uuid.uuid4())
         virtual_resource_uri = f"http://data.lblod.info/files/{virtual_resource_uuid}"
         file_created = datetime.datetime.now()
-        update_sudo(f"""
+        return f"""
 PREFIX mu: <http://mu.semte.ch/vocabularies/core/>
 PREFIX nfo: <http://www.semanticdesktop.org/ontologies/2007/03/22/nfo#>
 PREFIX nie: <http://www.semanticdesktop.org/ontologies/2007/01/19/nie#>
@@ -457,4 +438,4 @@ PREFIX    adms: <http://www.w3.org/ns/adms#>
           }}
         }}
 
-        """)
+        """
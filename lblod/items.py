@@ -15,3 +15,7 @@ class Page(Item):
     format = Field(output_processor=TakeFirst())
     physical_file_name = Field(output_processor=TakeFirst()) 
     physical_file_path = Field(output_processor=TakeFirst())
+    etag = Field(output_processor=TakeFirst())
+    last_modified = Field(output_processor=TakeFirst())
+    content_type = Field(output_processor=TakeFirst())
+    previous = Field(output_processor=TakeFirst())
@@ -12,13 +12,12 @@ from constants import SCRAPE_JOB_TYPE, RESOURCE_BASE, DEFAULT_GRAPH, TASK_STATUS
 # TODO: keep this generic and extract into packaged module later
 ############################################################
 
-class TaskNotFoundException(Exception):
-    "Raised when task is not found"
-    pass
-
-
-def fail_busy_and_scheduled_tasks():
+def fail_busy_and_scheduled_tasks(keep=()):
+    """Fail busy and scheduled collecting tasks, except for the tasks in keep (e.g. still queued to run)"""
     logger.info("Startup: failing busy tasks if there are any")
+    keep_filter = ""
+    if keep:
+        keep_filter = f"FILTER(?task NOT IN ({', '.join(sparql_escape_uri(task) for task in keep)}))"
     update_sudo(f"""
   PREFIX mu: <http://mu.semte.ch/vocabularies/core/>
   PREFIX dct: <http://purl.org/dc/terms/>
@@ -44,66 +43,61 @@ def fail_busy_and_scheduled_tasks():
     {sparql_escape_uri(TASK_STATUSES["BUSY"])}
     {sparql_escape_uri(TASK_STATUSES["SCHEDULED"])}
     }}
+    {keep_filter}
     }}
   }}
 
     """)
 
-def load_task(subject, graph = DEFAULT_GRAPH):
+def load_tasks(subjects, graph = DEFAULT_GRAPH):
+    """Load several tasks in one query, returns a dict of task uri to task for the tasks found"""
     query_template = Template("""
   PREFIX mu: <http://mu.semte.ch/vocabularies/core/>
   PREFIX dct: <http://purl.org/dc/terms/>
   PREFIX adms: <http://www.w3.org/ns/adms#>
   PREFIX task: <http://redpencil.data.gift/vocabularies/tasks/>
-  SELECT DISTINCT ?id ?job ?jobId ?created ?modified ?status ?index ?operation ?error WHERE {
+  SELECT DISTINCT ?task ?id ?job ?jobId ?status ?index ?operation ?error WHERE {
       GRAPH $graph {
-        $subject a task:Task .
-        $subject dct:isPartOf ?job;
-                      mu:uuid ?id;
-                      dct:created ?created;
-                      dct:modified ?modified;
-                      adms:status ?status;
-                      task:index ?index;
-                      task:operation ?operation.
+        VALUES ?task {
+          $subjects
+        }
+        ?task a task:Task ;
+              dct:isPartOf ?job;
+              mu:uuid ?id;
+              dct:created ?created;
+              dct:modified ?modified;
+              adms:status ?status;
+              task:index ?index;
+              task:operation ?operation.
         ?job mu:uuid ?jobId.
-        OPTIONAL { $subject task:error ?error. }
+        OPTIONAL { ?task task:error ?error. }
       }
     }
-
     """)
-
     query_string = query_template.substitute(
         graph = sparql_escape_uri(graph),
-        subject = sparql_escape_uri(subject)
+        subjects = "\n".join(sparql_escape_uri(subject) for subject in subjects)
     )
-
     results = query_sudo(query_string)
-    bindings = results["results"]["bindings"]
-    if len(bindings) == 1:
-        item = bindings[0]
-        id = item['id']['value']
-        job = item['job']['value']
-        job_id = item['jobId']['value']
-        status = item['status']['value']
-        index = item['index']['value']
-        operation = item['operation']['value']
-        error = item.get('error', {}).get('value', None)
-        return {
-            'id': id,
-            'job': job,
-            'job_id' : job_id,
-            'status': status,
-            'operation': operation,
-            'index': index,
-            'error': error,
+    tasks = {}
+    for item in results["results"]["bindings"]:
+        subject = item['task']['value']
+        if subject in tasks:
+            logger.warning(f"Unexpected result loading task {subject}, it has several values for a property")
+            continue
+        tasks[subject] = {
+            'id': item['id']['value'],
+            'job': item['job']['value'],
+            'job_id' : item['jobId']['value'],
+            'status': item['status']['value'],
+            'operation': item['operation']['value'],
+            'index': item['index']['value'],
+            'error': item.get('error', {}).get('value', None),
             'uri': subject
         }
-    elif len(bindings) == 0:
-        raise TaskNotFoundException()
-    else:
-        raise Exception(f"Unexpected result loading task: {results}")
+    return tasks
 
-def update_task_status (task, status, graph=DEFAULT_GRAPH):
+def construct_update_task_status_query(task, status, graph=DEFAULT_GRAPH):
     query_template = Template("""
     PREFIX mu: <http://mu.semte.ch/vocabularies/core/>
     PREFIX adms: <http://www.w3.org/ns/adms#>
@@ -129,11 +123,50 @@ def update_task_status (task, status, graph=DEFAULT_GRAPH):
       }
     }
     """)
-    time = datetime.datetime.now()
     query_string = query_template.substitute(
         graph=sparql_escape_uri(graph),
         subject=sparql_escape_uri(task),
         modified=sparql_escape_datetime(datetime.datetime.now()),
         status=sparql_escape_uri(status)
     )
+    return query_string
+
+def update_tasks_status(tasks, status, graph=DEFAULT_GRAPH):
+    """Set the status of several tasks in one update"""
+    if not tasks:
+        return
+    query_template = Template("""
+    PREFIX mu: <http://mu.semte.ch/vocabularies/core/>
+    PREFIX adms: <http://www.w3.org/ns/adms#>
+    PREFIX dct: <http://purl.org/dc/terms/>
+    PREFIX task: <http://redpencil.data.gift/vocabularies/tasks/>
+    DELETE {
+      GRAPH $graph {
+        ?subject adms:status ?status .
+        ?subject dct:modified ?modified.
+      }
+    }
+    INSERT {
+      GRAPH $graph {
+        ?subject adms:status $status.
+        ?subject dct:modified $modified.
+      }
+    }
+    WHERE {
+      GRAPH $graph {
+        VALUES ?subject {
+          $subjects
+        }
+        ?subject a task:Task.
+        ?subject adms:status ?status .
+        OPTIONAL { ?subject dct:modified ?modified. }
+      }
+    }
+    """)
+    query_string = query_template.substitute(
+        graph=sparql_escape_uri(graph),
+        subjects="\n".join(sparql_escape_uri(task) for task in tasks),
+        modified=sparql_escape_datetime(datetime.datetime.now()),
+        status=sparql_escape_uri(status)
+    )
     update_sudo(query_string)
@@ -0,0 +1,200 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+from helpers import logger
+from .file import STORAGE_PATH
+from .checkpoint import is_resumable, remove_checkpoint
+
+JOB_QUEUE_PATH = os.path.join(STORAGE_PATH, "job-queue.sqlite")
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
+MAX_JOBS_PER_HOST = int(os.getenv("MAX_JOBS_PER_HOST", "1"))
+# seconds running crawls get to write their checkpoint when the service stops
+SHUTDOWN_TIMEOUT = int(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+
+PRIORITIES = {
+    "manual": 10,
+    "scheduled": 0
+}
+
+
+class JobQueue:
+    """
+    Persistent queue of crawl jobs, run by a bounded pool of worker processes.
+
+    Jobs are picked by priority (manual before scheduled), then in the order they were queued,
+    skipping jobs for hosts that already have MAX_JOBS_PER_HOST jobs running. The queue is kept in
+    sqlite so queued jobs survive a restart of the service.
+    """
+
+    def __init__(self, start_job, path=JOB_QUEUE_PATH, max_workers=MAX_WORKERS, max_jobs_per_host=MAX_JOBS_PER_HOST):
+        self.start_job = start_job
+        self.max_workers = max_workers
+        self.max_jobs_per_host = max_jobs_per_host
+        self.running = {}  # queue id -> (process, host)
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task TEXT,
+                host TEXT,
+                kwargs TEXT,
+                priority INTEGER,
+                status TEXT,
+                queued_at REAL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, id)")
+        self.connection.commit()
+
+    def recover(self):
+        """
+        Mark jobs that were running when the service stopped as interrupted and queue the interrupted jobs
+        again that can be resumed from their checkpoint. Returns the tasks that are queued.
+        """
+        with self.condition:
+            self.connection.execute("UPDATE jobs SET status = 'interrupted', finished_at = ? WHERE status = 'running'", (time.time(),))
+            for row in self.connection.execute("SELECT id, task, kwargs FROM jobs WHERE status = 'interrupted'").fetchall():
+                job_id = json.loads(row["kwargs"])["job_id"]
+                if is_resumable(job_id):
+                    logger.info(f"resuming interrupted job for task {row['task']}")
+                    self.connection.execute("UPDATE jobs SET status = 'queued', finished_at = NULL WHERE id = ?", (row["id"],))
+                else:
+                    # the task is failed on startup, its checkpoint is of no use
+                    self.connection.execute("UPDATE jobs SET status = 'failed' WHERE id = ?", (row["id"],))
+                    remove_checkpoint(job_id)
+            self.connection.commit()
+            rows = self.connection.execute("SELECT task FROM jobs WHERE status = 'queued'").fetchall()
+        return [row["task"] for row in rows]
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        """Stop the running crawls, they checkpoint their progress and are resumed by recover on the next startup."""
+        with self.condition:
+            self.stopped = True
+            for process, _ in self.running.values():
+                process.terminate()
+            deadline = time.time() + timeout
+            for process, _ in self.running.values():
+                process.join(max(0, deadline - time.time()))
+            self.connection.execute("UPDATE jobs SET status = 'interrupted', finished_at = ? WHERE status = 'running'", (time.time(),))
+            self.connection.commit()
+            self.running.clear()
+
+    def enqueue(self, kind="scheduled", **kwargs):
+        host = urlparse(kwargs["start_urls"][0]).netloc
+        with self.condition:
+            self.connection.execute(
+                "INSERT INTO jobs (task, host, kwargs, priority, status, queued_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (kwargs["task"], host, json.dumps(kwargs), PRIORITIES[kind], time.time())
+            )
+            self.connection.commit()
+            self.condition.notify()
+        logger.info(f"queued {kind} job for task {kwargs['task']} ({host})")
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="job-queue", daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                self._reap()
+                self._dispatch()
+                self.condition.wait(timeout=1)
+
+    def _reap(self):
+        for queue_id, (process, host) in list(self.running.items()):
+            if not process.is_alive():
+                status = "done" if process.exitcode == 0 else "failed"
+                if status == "failed":
+                    logger.error(f"crawl process for queued job {queue_id} exited with {process.exitcode}")
+                self.connection.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?", (status, time.time(), queue_id))
+                self.connection.commit()
+                del self.running[queue_id]
+
+    def _dispatch(self):
+        while len(self.running) < self.max_workers:
+            busy_hosts = [host for host, count in self._running_per_host().items() if count >= self.max_jobs_per_host]
+            row = self.connection.execute(
+                f"""SELECT * FROM jobs WHERE status = 'queued' AND host NOT IN ({", ".join("?" for _ in busy_hosts)})
+                    ORDER BY priority DESC, id LIMIT 1""",
+                busy_hosts
+            ).fetchone()
+            if not row:
+                return
+            self.connection.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (time.time(), row["id"]))
+            self.connection.commit()
+            logger.info(f"starting queued job for task {row['task']}, waited {time.time() - row['queued_at']:.1f} seconds")
+            try:
+                process = self.start_job(**json.loads(row["kwargs"]))
+            except Exception:
+                logger.exception(f"failed to start job for task {row['task']}")
+                self.connection.execute("UPDATE jobs SET status = 'failed', finished_at = ? WHERE id = ?", (time.time(), row["id"]))
+                self.connection.commit()
+                continue
+            self.running[row["id"]] = (process, row["host"])
+
+    def _running_per_host(self):
+        per_host = {}
+        for _, host in self.running.values():
+            per_host[host] = per_host.get(host, 0) + 1
+        return per_host
+
+    def job(self, job_id):
+        """Queue entry of the latest crawl of job_id, None if it isn't known"""
+        with self.condition:
+            row = self.connection.execute(
+                "SELECT * FROM jobs WHERE json_extract(kwargs, '$.job_id') = ? ORDER BY id DESC LIMIT 1", (job_id,)
+            ).fetchone()
+        if not row:
+            return None
+        position = None
+        if row["status"] == "queued":
+            with self.condition:
+                position = self.connection.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority > ? OR (priority = ? AND id < ?))",
+                    (row["priority"], row["priority"], row["id"])
+                ).fetchone()[0] + 1
+        return {
+            "task": row["task"],
+            "host": row["host"],
+            "status": row["status"],
+            "position": position,
+            "queued_at": row["queued_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"]
+        }
+
+    def metrics(self):
+        now = time.time()
+        with self.condition:
+            queued = self.connection.execute(
+                "SELECT priority, COUNT(*) AS count, MIN(queued_at) AS oldest FROM jobs WHERE status = 'queued' GROUP BY priority"
+            ).fetchall()
+            waits = self.connection.execute(
+                "SELECT started_at - queued_at AS wait FROM jobs WHERE started_at IS NOT NULL ORDER BY started_at DESC LIMIT 100"
+            ).fetchall()
+            running_per_host = self._running_per_host()
+        names = {priority: name for name, priority in PRIORITIES.items()}
+        return {
+            "max_workers": self.max_workers,
+            "max_jobs_per_host": self.max_jobs_per_host,
+            "running": len(self.running),
+            "running_per_host": running_per_host,
+            "queued": sum(row["count"] for row in queued),
+            "queued_per_priority": {names.get(row["priority"], row["priority"]): row["count"] for row in queued},
+            "oldest_queued_seconds": max((now - row["oldest"] for row in queued), default=0),
+            "average_wait_seconds": sum(row["wait"] for row in waits) / len(waits) if waits else 0,
+            "max_wait_seconds": max((row["wait"] for row in waits), default=0)
+        }
@@ -0,0 +1,282 @@
+import json
+import os
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.resolver import dnscache
+from twisted.internet import defer, reactor, threads
+from twisted.internet.error import TimeoutError, TCPTimedOutError, ConnectionRefusedError
+
+from helpers import logger
+from .file import STORAGE_PATH
+from .harvester import clean_url
+from .compression import read_file
+from .pipelines import get_storage_threadpool
+
+
+class ConditionalRequestMiddleware:
+    """
+    Downloader middleware adding If-None-Match/If-Modified-Since headers for urls that were stored in an
+    earlier run, the spider reuses the stored file when the server answers 304 Not Modified.
+    """
+
+    def process_request(self, request, spider):
+        crawl_state = getattr(spider, "crawl_state", None)
+        if not crawl_state or request.meta.get("dont_revalidate"):
+            return None
+        # looking up the page and checking its file would block the reactor, fires with None
+        return threads.deferToThreadPool(reactor, get_storage_threadpool(), self.add_validators, crawl_state, request)
+
+    def add_validators(self, crawl_state, request):
+        previous = crawl_state.get(clean_url(request.url))
+        if not previous or not previous["physical_file_path"] or not os.path.exists(previous["physical_file_path"]):
+            return None
+        if previous["etag"] and b"If-None-Match" not in request.headers:
+            request.headers["If-None-Match"] = previous["etag"]
+        if previous["last_modified"] and b"If-Modified-Since" not in request.headers:
+            request.headers["If-Modified-Since"] = previous["last_modified"]
+        return None
+
+    def process_response(self, request, response, spider):
+        crawl_state = getattr(spider, "crawl_state", None)
+        if response.status != 304 or not crawl_state:
+            return response
+        # looking up the page and reading (decompressing) its file would block the reactor
+        return threads.deferToThreadPool(reactor, get_storage_threadpool(), self.stored_response, crawl_state, request, response)
+
+    def stored_response(self, crawl_state, request, response):
+        """The 304 response with the page stored by an earlier run as body, the page is passed in meta["previous"]"""
+        previous = crawl_state.get(clean_url(response.url))
+        if not previous or not previous["physical_file_path"]:
+            return response
+        request.meta["previous"] = previous
+        headers = response.headers.copy()
+        if previous["content_type"]:
+            # a 304 doesn't repeat it, but the encoding of the body depends on it
+            headers["Content-Type"] = previous["content_type"]
+        return HtmlResponse(url=response.url, status=304, headers=headers, body=read_file(previous["physical_file_path"]), request=request)
+
+
+class HostLimiter:
+    """Counts running requests per host and lets requests wait until their host has room"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.limits = {}
+        self.active = defaultdict(int)
+        self.waiting = defaultdict(deque)
+
+    def limit_for(self, key):
+        return self.limits.get(key, self.limit)
+
+    def acquire(self, key):
+        if self.active[key] < self.limit_for(key):
+            self.active[key] += 1
+            return defer.succeed(key)
+        d = defer.Deferred()
+        self.waiting[key].append(d)
+        return d
+
+    def release(self, key):
+        self.active[key] -= 1
+        self._wake(key)
+
+    def set_limit(self, key, limit):
+        self.limits[key] = limit
+        self._wake(key)
+
+    def _wake(self, key):
+        while self.waiting[key] and self.active[key] < self.limit_for(key):
+            self.active[key] += 1
+            self.waiting[key].popleft().callback(key)
+        if not self.waiting[key]:
+            del self.waiting[key]
+        if not self.active[key]:
+            del self.active[key]
+
+
+# shared by all crawls running in the same process
+_host_limiter = None
+
+
+class HostConcurrencyMiddleware:
+    """
+    Downloader middleware limiting concurrent requests per host over all crawls in this process (to
+    CONCURRENT_REQUESTS_PER_DOMAIN). Scrapy only enforces this per crawl, which isn't enough when a shared
+    crawler process (see lblod.worker) runs several crawls against the same host.
+
+    Must be the last downloader middleware (closest to the downloader), so it sees every response and
+    exception before other middlewares can replace the request (retries, redirects).
+    """
+
+    def __init__(self, limit):
+        global _host_limiter
+        if _host_limiter is None:
+            _host_limiter = HostLimiter(limit)
+        self.limiter = _host_limiter
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN"))
+
+    def process_request(self, request, spider):
+        key = request.meta.get("download_slot") or urlparse(request.url).netloc
+        d = self.limiter.acquire(key)
+        d.addCallback(self._acquired, request)
+        return d
+
+    def _acquired(self, key, request):
+        request.meta["host_concurrency_key"] = key
+        return None
+
+    def _release(self, request):
+        key = request.meta.pop("host_concurrency_key", None)
+        if key is not None:
+            self.limiter.release(key)
+
+    def process_response(self, request, response, spider):
+        self._release(request)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self._release(request)
+        return None
+
+
+def platform_key(host, platform_suffixes):
+    """
+    Hosts of the same publication platform (e.g. <municipality>.meetingburger.net) or on the same ip
+    share their concurrency limits.
+    """
+    host = host.split(":")[0].lower()
+    for suffix in platform_suffixes:
+        if host == suffix or host.endswith(f".{suffix}"):
+            return suffix
+    ip = dnscache.get(host)
+    # only known after the first request to the host was resolved
+    return f"ip:{ip}" if ip else host
+
+
+class PlatformConcurrency:
+    """
+    Learns the number of concurrent requests a platform handles (additive increase, multiplicative
+    decrease): every fast response adds about one request per round trip, a response that is much
+    slower than the fastest seen takes it back, rate limiting (429), server errors and timeouts halve it.
+    The limits are stored when a crawl closes, so the next crawl starts from what was learned.
+    """
+
+    def __init__(self, start, maximum, path=os.path.join(STORAGE_PATH, "platform-concurrency.json")):
+        self.start = start
+        self.maximum = maximum
+        self.path = path
+        self.limits = self._load()
+        self.fastest = {}
+        self.last_decrease = {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save(self):
+        # other crawler processes may have learned limits for other platforms in the meantime
+        limits = self._load()
+        limits.update(self.limits)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(limits, f, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def limit(self, key):
+        return max(1, int(self.limits.setdefault(key, self.start)))
+
+    def response(self, key, latency):
+        limit = self.limits.setdefault(key, self.start)
+        fastest = self.fastest[key] = min(self.fastest.get(key, latency), latency)
+        if latency > 3 * max(fastest, 0.1):
+            self.limits[key] = max(1, limit - 1 / limit)
+        else:
+            self.limits[key] = min(self.maximum, limit + 1 / limit)
+
+    def congestion(self, key):
+        # once per 5 seconds, requests that were already running answer the same
+        if time.time() - self.last_decrease.get(key, 0) > 5:
+            self.limits[key] = max(1, self.limits.setdefault(key, self.start) / 2)
+            self.last_decrease[key] = time.time()
+            logger.info(f"{key} is congested, lowering its concurrency to {self.limit(key)}")
+
+
+# shared by all crawls running in the same process
+_platform_concurrency = None
+
+
+class AdaptiveConcurrencyMiddleware:
+    """
+    Downloader middleware grouping requests per platform (PLATFORM_SUFFIXES, or hosts on the same ip) in
+    one download slot, and adapting the concurrency of that slot to what the platform handles (see
+    PlatformConcurrency). Must run before HostConcurrencyMiddleware, which limits every slot over all
+    crawls in this process.
+    """
+
+    CONGESTION_STATUSES = {429, 500, 502, 503, 504, 522, 524}
+
+    def __init__(self, crawler):
+        global _platform_concurrency
+        self.crawler = crawler
+        self.platform_suffixes = crawler.settings.getlist("PLATFORM_SUFFIXES")
+        if _platform_concurrency is None:
+            _platform_concurrency = PlatformConcurrency(
+                crawler.settings.getint("PLATFORM_START_CONCURRENCY"),
+                crawler.settings.getint("PLATFORM_MAX_CONCURRENCY")
+            )
+        self.concurrency = _platform_concurrency
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ADAPTIVE_CONCURRENCY"):
+            raise NotConfigured
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def process_request(self, request, spider):
+        if "download_slot" not in request.meta:
+            request.meta["download_slot"] = platform_key(urlparse(request.url).netloc, self.platform_suffixes)
+        self._apply(request.meta["download_slot"])
+        return None
+
+    def process_response(self, request, response, spider):
+        key = request.meta.get("download_slot")
+        if response.status in self.CONGESTION_STATUSES:
+            self.concurrency.congestion(key)
+        elif "download_latency" in request.meta:
+            self.concurrency.response(key, request.meta["download_latency"])
+        self._apply(key)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, (TimeoutError, TCPTimedOutError, ConnectionRefusedError)):
+            key = request.meta.get("download_slot")
+            self.concurrency.congestion(key)
+            self._apply(key)
+        return None
+
+    def _apply(self, key):
+        limit = self.concurrency.limit(key)
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot:
+            slot.concurrency = limit
+        if _host_limiter:
+            _host_limiter.set_limit(key, limit)
+        self.crawler.stats.set_value(f"concurrency/{key}", limit)
+
+    def spider_closed(self, spider):
+        try:
+            self.concurrency.save()
+        except OSError as e:
+            logger.warning(f"could not store the learned platform concurrency: {e}")
@@ -1,75 +1,217 @@
 import datetime
+import hashlib
+import json
 import os
 import uuid
-from string import Template
 
 from itemadapter import ItemAdapter
-from constants import DEFAULT_GRAPH
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
 
-from escape_helpers import sparql_escape_uri
-from sudo_query import update_sudo
+from constants import DEFAULT_GRAPH, TASK_STATUSES
+from sudo_query import defer_to_sparql_pool, update_sudo_async
+from metrics import registry
 from helpers import logger
-import gzip
 
-from .file import construct_insert_file_query, STORAGE_PATH
-from constants import DEFAULT_GRAPH, RESOURCE_BASE, TASK_STATUSES
-from .job import update_task_status
-from .harvester import collection_has_collected_files, create_results_container, get_previous_pages, remove_random_10_percent_of_list, copy_files_to_results_container, store_report_metadata
+from .file import construct_insert_files_query, STORAGE_PATH
+from .job import construct_update_task_status_query
+from .harvester import clean_url, get_scheduled_job, construct_insert_remote_data_objects_query, collection_has_collected_files, new_results_container, construct_insert_results_container_query, get_results_container, construct_link_files_to_results_container_query, construct_insert_report_query, get_remote_data_objects
 from .extendedjsonencoder import ExtendedJsonEncoder
-
-import json
+from .writer import BatchedUpdateWriter
+from .rdo_index import RemoteDataObjectIndex
+from .crawl_state import CrawlState
+from .compression import Codec, file_format
+from .url_set import new_url_set
+from .refetch import RefetchPolicy
+from .spill import spill, spill_path, has_spilled, replay
 
 INCREMENTAL_RETRIEVAL = os.getenv("INCREMENTAL_RETRIEVAL") in ["yes", "on", "true", True, "1", 1]
+DEDUPLICATE_PAGES = os.getenv("DEDUPLICATE_PAGES", "false") in ["yes", "on", "true", True, "1", 1]
+# threads compressing and writing pages, at most twice as many pages wait for a thread
+STORAGE_THREADPOOL_SIZE = int(os.getenv("STORAGE_THREADPOOL_SIZE", "2"))
+
+_storage_threadpool = None
+
+
+def get_storage_threadpool():
+    # shared by all crawls running in the same process, and by ConditionalRequestMiddleware
+    global _storage_threadpool
+    if _storage_threadpool is None:
+        _storage_threadpool = ThreadPool(minthreads=1, maxthreads=STORAGE_THREADPOOL_SIZE, name="storage")
+        _storage_threadpool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _storage_threadpool.stop)
+    return _storage_threadpool
 
 class Pipeline:
 
     def __init__(self):
         self.timestamp = datetime.datetime.now()
         self.storage_path = STORAGE_PATH
+        self.codec = Codec()
+        # pages waiting to be stored hold on to their response, so the crawl slows down
+        # (scrapy stops downloading while too many responses are being processed)
+        self.storage_slots = defer.DeferredSemaphore(2 * STORAGE_THREADPOOL_SIZE)
         if not os.path.exists(self.storage_path):
             os.mkdir(self.storage_path)
 
+    # Several crawls can share a reactor (see lblod.worker), the triplestore is only queried on the SPARQL
+    # thread pool and updated with update_sudo_async, so opening or closing one doesn't hold up the others.
+
+    @defer.inlineCallbacks
     def open_spider(self, spider):
+        self.write_failed = False
+        spider.crawl_state = None
+        spider.previous_collected_pages = new_url_set()
+        # files are linked to the results container as they are stored, a resumed crawl keeps its container
+        self.results_container = yield defer_to_sparql_pool(get_results_container, spider.task)
+        if not self.results_container:
+            container = new_results_container()
+            yield update_sudo_async(construct_insert_results_container_query(spider.task, container))
+            self.results_container = container["uri"]
+        # remote data objects first, the file query expects them to exist
+        self.writer = BatchedUpdateWriter(
+            {
+                "remote_data_objects": lambda rdos: construct_insert_remote_data_objects_query(spider.collection, rdos),
+                "files": lambda files: construct_insert_files_query(files, DEFAULT_GRAPH),
+                "results_container": lambda rdos: construct_link_files_to_results_container_query(self.results_container, rdos)
+            },
+            stats=spider.crawler.stats,
+            on_failure=self.on_write_failure,
+            spill_path=spill_path(spider.job_id)
+        )
+        self.writer.start()
+        uris = yield defer_to_sparql_pool(get_remote_data_objects, spider.collection)
+        self.remote_data_objects = RemoteDataObjectIndex(spider.collection, self.writer, uris)
         if INCREMENTAL_RETRIEVAL:
-            previous_collected_pages = get_previous_pages(spider.task)
-            spider.previous_collected_pages = set(remove_random_10_percent_of_list(previous_collected_pages))
-        else:
-            spider.previous_collected_pages = set()
+            # only scheduled jobs have previous executions to compare with
+            scheduled_job = yield defer_to_sparql_pool(get_scheduled_job, spider.task)
+            if scheduled_job:
+                spider.crawl_state = yield defer_to_sparql_pool(
+                    self.load_crawl_state, scheduled_job, spider, spider.previous_collected_pages
+                )
+
+    def load_crawl_state(self, scheduled_job, spider, previous_collected_pages):
+        """Open the crawl state of a scheduled job and fill previous_collected_pages, runs on the SPARQL thread pool"""
+        crawl_state = CrawlState.for_scheduled_job(scheduled_job)
+        if not crawl_state.has_jobs():
+            crawl_state.rebuild_from_triplestore(spider.task)
+        crawl_state.update_job(spider.job_id, "busy")
+        refetch = RefetchPolicy(crawl_state.run_number())
+        due = 0
+        for url, fetched_at in crawl_state.previous_pages():
+            if refetch.is_due(url, fetched_at):
+                due += 1
+            else:
+                previous_collected_pages.add(url)
+        logger.info(f"found {len(previous_collected_pages) + due} previously harvested urls, "
+                    f"{len(previous_collected_pages)} should not be harvested again, {due} are due for a refetch")
+        return crawl_state
+
+    def on_write_failure(self, exception):
+        logger.error(f"Encountered exception while trying to write harvested files to triplestore: {exception}")
+        self.write_failed = True
 
     def close_spider(self, spider):
+        # write out what's still buffered before the results are linked
+        d = self.writer.close()
+        if not spider.crawler.crawling:
+            # stopped by a shutdown of the service, the crawl is resumed from its checkpoint on startup
+            d.addBoth(lambda _: self.suspend_task(spider))
+        else:
+            d.addBoth(lambda _: self.replay_spilled(spider))
+            d.addBoth(lambda _: self.finish_task(spider))
+        return d
+
+    def replay_spilled(self, spider):
+        """Write the batches that were spilled during the crawl, the results are incomplete without them"""
+        path = spill_path(spider.job_id)
+        if not has_spilled(path):
+            return None
+        d = defer_to_sparql_pool(replay, path, max_retries=0)
+
+        def replayed(complete):
+            if not complete:
+                # replayed later by the web process, see web.replay_spilled_updates
+                self.on_write_failure(f"spilled updates in {path} could not be written yet")
+
+        d.addCallbacks(replayed, lambda failure: self.on_write_failure(failure.value))
+        return d
+
+    def suspend_task(self, spider):
+        logger.info(f"suspending task {spider.task}, leaving it busy")
+        # saved with the checkpoint, see lblod.extensions.Checkpoint
+        if hasattr(spider, "state"):
+            spider.state["failed_urls"] = spider.state.get("failed_urls", []) + spider.failed_urls
+        if spider.crawl_state:
+            spider.crawl_state.close()
+
+    @defer.inlineCallbacks
+    def finish_task(self, spider):
         try:
-            results_container = create_results_container(spider.task, spider.collection)
-            self.store_report(spider, results_container)
-            if collection_has_collected_files(spider.collection):
-                copy_files_to_results_container(spider.collection, results_container)
-                update_task_status(spider.task, TASK_STATUSES["SUCCESS"])
+            yield self.store_report(spider, self.results_container)
+            # left when the crawl ran out of budget, the next run continues with them whatever the outcome of this one
+            pending_requests = getattr(spider, "pending_requests", [])
+            if spider.crawl_state and pending_requests:
+                spider.crawl_state.set_frontier(pending_requests)
+            if self.write_failed:
+                logger.error("not all harvested files could be written to the triplestore")
+                yield self.fail_task(spider)
+            elif (yield defer_to_sparql_pool(collection_has_collected_files, spider.collection)):
+                yield update_sudo_async(construct_update_task_status_query(spider.task, TASK_STATUSES["SUCCESS"]))
+                if spider.crawl_state:
+                    spider.crawl_state.update_job(spider.job_id, "success")
+                    if not pending_requests:
+                        # got to everything an earlier run left
+                        spider.crawl_state.set_frontier([])
             else:
                 logger.error("spider closed without collecting files")
-                update_task_status(spider.task, TASK_STATUSES["FAILED"])
+                yield self.fail_task(spider)
 
         except Exception as e:
             logger.error(e)
             logger.error("failure while closing spider, attempting to set task to failed")
-            update_task_status(spider.task, TASK_STATUSES["FAILED"])
+            yield self.fail_task(spider)
+        finally:
+            if spider.crawl_state:
+                spider.crawl_state.close()
 
+    @defer.inlineCallbacks
+    def fail_task(self, spider):
+        query = construct_update_task_status_query(spider.task, TASK_STATUSES["FAILED"])
+        try:
+            yield update_sudo_async(query)
+        except Exception as e:
+            # most likely the triplestore is down (or the circuit breaker is open), the web process
+            # replays the spill file once it's back, see web.replay_spilled_updates
+            logger.error(f"could not set task {spider.task} to failed, spilling the status update: {e}")
+            spill(spill_path(spider.job_id), query)
 
+    @defer.inlineCallbacks
     def store_report(self, spider, results_container):
         stats = spider.crawler.stats.get_stats()
         data = {
             "stats": stats,
-            "failed_urls": spider.failed_urls,
+            # including the urls that failed before the crawl was resumed
+            "failed_urls": getattr(spider, "state", {}).get("failed_urls", []) + spider.failed_urls,
+            # left when the crawl ran out of budget
+            "pending_urls": [url for url, _ in getattr(spider, "pending_requests", [])],
+            # start time, pages fetched and items stored over all runs of a resumed crawl, the stats only
+            # cover the last run (see lblod.extensions.ProgressReporter)
+            "progress": getattr(spider, "state", {}).get("progress"),
         }
         # Store report in job-specific subfolder like other files
-        job_id = spider.job_id
-        base_folder = os.path.join(self.storage_path, job_id, "scrape")
-        os.makedirs(base_folder, exist_ok=True)
+        base_folder = os.path.join(self.storage_path, spider.job_id, "scrape")
         physical_file_name = "00-scrape-report.json"
         physical_file_path = os.path.join(base_folder, physical_file_name)
+        size = yield threads.deferToThreadPool(reactor, get_storage_threadpool(), self.write_report, physical_file_path, data)
+        yield update_sudo_async(construct_insert_report_query(physical_file_path, physical_file_name, results_container, size))
+
+    def write_report(self, physical_file_path, data):
+        os.makedirs(os.path.dirname(physical_file_path), exist_ok=True)
         with open(physical_file_path, "w") as f:
             json.dump(data, f, indent=2, cls=ExtendedJsonEncoder)
             f.flush()
-            size = f.tell()
-        store_report_metadata(physical_file_path, physical_file_name, results_container, size)
+            return f.tell()
 
     def process_spider_exception(self, response, exception, spider):
         # Extract the relevant information from the failed response
@@ -78,45 +220,100 @@ class Pipeline:
         error_message = str(exception)
         logger.error(error_message)
 
+    @defer.inlineCallbacks
     def process_item(self, item, spider):
         adapter = ItemAdapter(item)
         job_id = adapter.get('job_id')
         contents = adapter.get("contents")
-        remote_data_object = adapter.get("rdo")
-        if isinstance(contents, (bytes, bytearray)):
-            write_mode = "wb"
-        elif isinstance(contents, str):
-            write_mode = "w"
-        else:
+        if isinstance(contents, str):
+            contents = contents.encode()
+        elif not isinstance(contents, (bytes, bytearray)):
             # Can't write a file that isn't a (byte)string
             return item
 
-        base_folder = os.path.join(self.storage_path, job_id, "scrape")
-        os.makedirs(base_folder, exist_ok = True)
+        adapter["rdo"] = self.remote_data_objects.ensure(adapter["url"])
 
-        _uuid = str(uuid.uuid4())
-        physical_file_name = f"{_uuid}.html.gz"
-        physical_file_path = os.path.join(base_folder, physical_file_name)
-        with gzip.open(physical_file_path, write_mode) as f:
-            f.write(contents.encode())
-        size = os.stat(physical_file_path).st_size
-        file_created = datetime.datetime.now()
+        previous = adapter.get("previous")
+        if previous:
+            # not modified since an earlier run, link the file that was stored back then
+            _uuid = previous["physical_file_uuid"]
+            physical_file_path = previous["physical_file_path"]
+            physical_file_name = os.path.basename(physical_file_path)
+            size = previous["size"]
+            file_created = datetime.datetime.fromisoformat(previous["file_created"])
+            content_hash = previous["content_hash"]
+        else:
+            _uuid, physical_file_name, physical_file_path, size, file_created, content_hash = yield self.storage_slots.run(
+                threads.deferToThreadPool, reactor, get_storage_threadpool(), self.store_page, job_id, contents
+            )
         adapter["uuid"] = _uuid
         adapter["size"] = size
         adapter["file_created"] = file_created
         adapter["extension"] = "html"
-        adapter["format"] = "application/gzip"
+        adapter["format"] = file_format(physical_file_path)
         adapter["physical_file_name"] = physical_file_name
         adapter["physical_file_path"] = physical_file_path
-        try:
-            self.push_item_to_triplestore(adapter)
-        except Exception as e:
-            logger.error(f"Encountered exception while trying to write data to triplestore for item generated by scraping {adapter['url']}")
-            update_task_status(spider.task, TASK_STATUSES["FAILED"])
-            raise e from None
+        # buffered, the writer reports failures through on_write_failure
+        yield self.push_item_to_triplestore(adapter)
+        yield self.writer.add("results_container", adapter["rdo"]["uri"])
+        if spider.crawl_state:
+            yield threads.deferToThreadPool(
+                reactor, get_storage_threadpool(), self.record_crawl_state, spider.crawl_state, adapter, content_hash
+            )
 
         return item
 
+    def store_page(self, job_id, data):
+        """
+        Compress and write the page to disk, runs on the storage thread pool. With DEDUPLICATE_PAGES, pages
+        are stored by the hash of their contents in a store shared by all jobs, so identical pages are only
+        written (and compressed) once.
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        if DEDUPLICATE_PAGES:
+            base_folder = os.path.join(self.storage_path, "scrape-store", content_hash[:2])
+            # uuid derived from the hash, so linking the same physical file again doesn't add triples
+            _uuid = str(uuid.UUID(content_hash[:32]))
+            physical_file_name = f"{content_hash}.html{self.codec.suffix}"
+        else:
+            base_folder = os.path.join(self.storage_path, job_id, "scrape")
+            _uuid = str(uuid.uuid4())
+            physical_file_name = f"{_uuid}.html{self.codec.suffix}"
+        os.makedirs(base_folder, exist_ok = True)
+        physical_file_path = os.path.join(base_folder, physical_file_name)
+        if not os.path.exists(physical_file_path):
+            # write next to the target and rename, other crawls may be storing the same page
+            tmp_path = f"{physical_file_path}.{uuid.uuid4()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(self.codec.compress(data))
+                registry.inc("scraper_storage_bytes_written_total", f.tell())
+            os.replace(tmp_path, physical_file_path)
+        else:
+            logger.debug(f"{physical_file_path} already stored, linking it")
+        # time of this harvest, a deduplicated file may have been written by an earlier job
+        file_created = datetime.datetime.now()
+        return _uuid, physical_file_name, physical_file_path, os.path.getsize(physical_file_path), file_created, content_hash
+
+    def record_crawl_state(self, crawl_state, item, content_hash):
+        """Runs on the storage thread pool, like the lookups of ConditionalRequestMiddleware"""
+        previous = item.get("previous") or {}
+        etag = item.get("etag")
+        last_modified = item.get("last_modified")
+        content_type = item.get("content_type")
+        crawl_state.record(
+            clean_url(item["url"]),
+            etag = etag.decode() if etag else previous.get("etag"),
+            last_modified = last_modified.decode() if last_modified else previous.get("last_modified"),
+            content_type = content_type.decode() if content_type else previous.get("content_type"),
+            content_hash = content_hash,
+            doc_type = item["doc_type"],
+            job_id = item["job_id"],
+            physical_file_path = item["physical_file_path"],
+            physical_file_uuid = item["uuid"],
+            size = item["size"],
+            file_created = item["file_created"].isoformat()
+        )
+
     def push_item_to_triplestore(self, item):
         virtual_resource_uuid = str(uuid.uuid4())
         virtual_resource_uri = f"http://data.lblod.info/files/{virtual_resource_uuid}"
@@ -140,7 +337,4 @@ class Pipeline:
             "name": item["physical_file_name"]
         }
 
-        ins_file_q_string = construct_insert_file_query(file,
-                                                        physical_file,
-                                                        DEFAULT_GRAPH)
-        update_sudo(ins_file_q_string)
+        return self.writer.add("files", (file, physical_file))
@@ -0,0 +1,25 @@
+import json
+import os
+
+from .file import STORAGE_PATH
+
+
+def progress_path(job_id):
+    return os.path.join(STORAGE_PATH, job_id, "progress.json")
+
+
+def write_progress(job_id, progress):
+    path = progress_path(job_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(progress, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_progress(job_id):
+    """Last progress reported by the crawl of job_id, None if it didn't start yet"""
+    try:
+        with open(progress_path(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
@@ -0,0 +1,29 @@
+from .harvester import clean_url, new_remote_data_object
+
+
+class RemoteDataObjectIndex:
+    """
+    In memory url -> remote data object lookup for a harvesting collection.
+
+    The existing remote data objects are loaded once when the crawl starts (`uris`, see
+    harvester.get_remote_data_objects), new ones are minted locally and handed to the batched writer. Because lookups and inserts happen on
+    the reactor thread, two responses for the same url can't create two remote data objects.
+    """
+
+    def __init__(self, collection, writer, uris):
+        self.collection = collection
+        self.writer = writer
+        self.uris = uris
+
+    def __len__(self):
+        return len(self.uris)
+
+    def ensure(self, url):
+        key = clean_url(url)
+        uri = self.uris.get(key)
+        if uri:
+            return {'url': url, 'uri': uri}
+        rdo = new_remote_data_object(url)
+        self.uris[key] = rdo['uri']
+        self.writer.add("remote_data_objects", rdo)
+        return rdo
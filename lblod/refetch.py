@@ -0,0 +1,32 @@
+import datetime
+import hashlib
+import os
+
+# fraction of the previously harvested pages a run fetches again, every page is refetched at least
+# once every 1/REFETCH_FRACTION runs
+REFETCH_FRACTION = float(os.getenv("REFETCH_FRACTION", "0.1"))
+# pages fetched longer ago than this are always refetched
+REFETCH_MAX_AGE_DAYS = int(os.getenv("REFETCH_MAX_AGE_DAYS", "30"))
+
+
+def _bucket(url, windows):
+    # stable over runs and processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), "little") % windows
+
+
+class RefetchPolicy:
+    """
+    Decides per url whether a run fetches a previously harvested page again. Urls are spread over
+    1/fraction windows by a hash of the url, run n refetches the pages of window n, so every page is
+    revalidated within 1/fraction runs. Pages older than max_age_days are refetched regardless.
+    """
+
+    def __init__(self, run, fraction=REFETCH_FRACTION, max_age_days=REFETCH_MAX_AGE_DAYS, now=None):
+        self.windows = max(1, round(1 / fraction)) if fraction > 0 else None
+        self.window = run % self.windows if self.windows else None
+        self.fetched_before = ((now or datetime.datetime.now()) - datetime.timedelta(days=max_age_days)).isoformat()
+
+    def is_due(self, url, fetched_at=None):
+        if fetched_at and fetched_at < self.fetched_before:
+            return True
+        return self.windows is not None and _bucket(url, self.windows) == self.window
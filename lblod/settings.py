@@ -57,23 +57,50 @@ CONCURRENT_ITEMS = 1
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+DOWNLOADER_MIDDLEWARES = {
+    "lblod.middlewares.ConditionalRequestMiddleware": 500,
+    "lblod.middlewares.AdaptiveConcurrencyMiddleware": 940,
+    "lblod.middlewares.HostConcurrencyMiddleware": 950,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 EXTENSIONS = {
    "scrapy.extensions.closespider.CloseSpider": 100,
+   # after scrapy's SpiderState (0), see lblod.extensions.Checkpoint
+   "lblod.extensions.Checkpoint": 500,
+   "lblod.extensions.MetricsExporter": 600,
+   "lblod.extensions.ProgressReporter": 610,
+   "lblod.extensions.CrawlBudget": 700,
 }
+# default budgets of a crawl (0 is unlimited), jobs can set their own, see lblod.extensions.CrawlBudget
+CRAWL_BUDGET_SECONDS = float(os.getenv("CRAWL_BUDGET_SECONDS", "0"))
+CRAWL_BUDGET_BYTES = float(os.getenv("CRAWL_BUDGET_BYTES", "0"))
+CRAWL_BUDGET_SPARQL_WRITES = float(os.getenv("CRAWL_BUDGET_SPARQL_WRITES", "0"))
 # CLOSESPIDER_PAGECOUNT=100
 
 # Configure item _pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+# keeps the seen request fingerprints in a compact set, see lblod.url_set
+DUPEFILTER_CLASS = "lblod.dupefilters.CompactDupeFilter"
+
 ITEM_PIPELINES = {
     "lblod.pipelines.Pipeline": 0,
 }
 
+# Learn the concurrency per platform (hosts with one of these suffixes, or on the same ip) from
+# response times, 429 and 5xx responses, see lblod.middlewares.AdaptiveConcurrencyMiddleware
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "true") in ["yes", "on", "true", True, "1", 1]
+PLATFORM_SUFFIXES = os.getenv("PLATFORM_SUFFIXES", "meetingburger.net,gelinkt-notuleren.vlaanderen.be").split(",")
+PLATFORM_START_CONCURRENCY = int(os.getenv("PLATFORM_START_CONCURRENCY", "2"))
+PLATFORM_MAX_CONCURRENCY = int(os.getenv("PLATFORM_MAX_CONCURRENCY", "8"))
+# the learned concurrency is the limit, scrapy's per domain limit would otherwise cap it
+CONCURRENT_REQUESTS_PER_DOMAIN = PLATFORM_MAX_CONCURRENCY
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-AUTOTHROTTLE_ENABLED = True
+# replaced by the concurrency learned per platform, see lblod.middlewares.AdaptiveConcurrencyMiddleware
+AUTOTHROTTLE_ENABLED = not ADAPTIVE_CONCURRENCY
 # The initial download delay
 # AUTOTHROTTLE_START_DELAY = 5
 # The maximum download delay to be set in case of high latencies
@@ -11,7 +11,9 @@ from rdflib import Graph, Namespace
 from helpers import logger
 
 from lblod.items import Page
-from lblod.harvester import ensure_remote_data_object, clean_url
+from lblod.harvester import clean_url
+from lblod.extractor import extract_annotations
+from lblod.frontier import link_priority
 
 BESLUIT = Namespace("http://data.vlaanderen.be/ns/besluit#")
 LBBESLUIT = Namespace("http://lblod.data.gift/vocabularies/besluit/")
@@ -51,6 +53,8 @@ def doc_type_from_type_ofs(type_ofs):
 
 class LBLODSpider(Spider):
     name = "LBLODSpider"
+    # not modified responses to conditional requests, see ConditionalRequestMiddleware
+    handle_httpstatus_list = [304]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -62,6 +66,14 @@ class LBLODSpider(Spider):
     def start_requests(self):
         for url in self.start_urls:
             yield scrapy.Request(url, callback=self.parse, errback=self.errback_http)
+        # continue with what the previous run didn't get to (see lblod.extensions.CrawlBudget), the crawl
+        # state is opened by the pipeline before the start requests are consumed
+        if getattr(self, "crawl_state", None):
+            frontier = self.crawl_state.frontier()
+            if frontier:
+                logger.info(f"continuing with {len(frontier)} requests left by the previous run")
+            for url, priority in frontier:
+                yield scrapy.Request(url, callback=self.parse, errback=self.errback_http, priority=priority)
 
     def errback_http(self, failure):
         url = failure.request.url
@@ -79,30 +91,39 @@ class LBLODSpider(Spider):
         self.failed_urls.append(url)
 
     def parse(self, response):
+        # not modified, ConditionalRequestMiddleware put the stored page in the response
+        previous = response.meta.get("previous") if response.status == 304 else None
+        if previous:
+            logger.info(f"{response.url} not modified, reusing {previous['physical_file_path']}")
         if not isinstance(response, TextResponse):
             raise IgnoreRequest("ignoring non text response")
 
+        # single pass over the page for everything we need from it
+        type_ofs, links = extract_annotations(response.text)
+
         # store page itself
-        type_ofs = response.xpath('//@typeof').getall()
         doc_type = doc_type_from_type_ofs(type_ofs)
         if doc_type != GENERAL_PAGE_TYPE or STORE_ALL_PAGES:
-            rdo = ensure_remote_data_object(self.collection, response.url)
-            page = ItemLoader(item=Page(), response=response)
+            # the remote data object is resolved in the pipeline. Without the response, so the loader
+            # doesn't build a selector (and parse the page again) for values that are all added directly
+            page = ItemLoader(item=Page())
             page.add_value("url", response.url)
-            page.add_value("contents", response.text)
-            page.add_value("rdo", rdo)
+            # stored as received, the pipeline doesn't have to encode the text again
+            page.add_value("contents", response.body)
             page.add_value("job_id", self.job_id)
             page.add_value("doc_type", doc_type)
+            page.add_value("etag", response.headers.get("ETag"))
+            page.add_value("last_modified", response.headers.get("Last-Modified"))
+            page.add_value("content_type", response.headers.get("Content-Type"))
+            page.add_value("previous", previous)
             yield page.load_item()
 
-        for element in response.xpath('//a[@href and @property]'):
-            href = element.xpath('@href').get()
-            property_value = element.xpath('@property').get()
+        for href, property_value in links:
             if not INTERESTING_PROPERTIES or any(value in property_value for value in INTERESTING_PROPERTIES):
                 if not href.endswith('.pdf'):
                     url = clean_url(response.urljoin(href))
                     if not url in self.previous_collected_pages:
-                        yield response.follow(url, errback=self.errback_http)
+                        yield response.follow(url, errback=self.errback_http, priority=link_priority(url, property_value))
                     else:
                         logger.info(f"ignoring previously harvested url {url}")
                 else:
@@ -0,0 +1,68 @@
+import datetime
+import json
+import os
+
+from helpers import logger
+from sudo_query import update_sudo
+from constants import SPARQL_SPILL_PATH, SPARQL_UPDATE_RETRIES
+
+
+def spill_path(job_id):
+    return os.path.join(SPARQL_SPILL_PATH, f"{job_id}.jsonl")
+
+
+def spill(path, query):
+    """Append an update that couldn't be written to the spill file of a job, durably"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps({"query": query, "spilled_at": datetime.datetime.now().isoformat()}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def has_spilled(path):
+    return os.path.exists(path) or os.path.exists(f"{path}.replaying")
+
+
+def _replay_file(path, max_retries):
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    for i, entry in enumerate(entries):
+        try:
+            update_sudo(entry["query"], max_retries=max_retries)
+        except Exception as e:
+            # keep what's left, in order, for the next replay
+            with open(f"{path}.tmp", "w") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in entries[i:])
+            os.replace(f"{path}.tmp", path)
+            logger.warning(f"replaying {path} failed, {len(entries) - i} updates left: {e}")
+            return False
+    os.remove(path)
+    return True
+
+
+def replay(path, max_retries=SPARQL_UPDATE_RETRIES):
+    """
+    Write the spilled updates of a job to the triplestore in the order they were spilled. Returns whether
+    everything was written, what's left stays for the next replay.
+
+    Blocks while retrying, a crawl replays without retries (max_retries=0) so it doesn't hold a thread of the
+    SPARQL pool and leaves the rest to the web process.
+    """
+    replaying = f"{path}.replaying"
+    # left by an earlier replay, older than what's in the spill file now
+    if os.path.exists(replaying) and not _replay_file(replaying, max_retries):
+        return False
+    if not os.path.exists(path):
+        return True
+    # updates spilled while replaying go to a new spill file
+    os.replace(path, replaying)
+    logger.info(f"replaying spilled updates of {path}")
+    return _replay_file(replaying, max_retries)
+
+
+def spilled_jobs():
+    """Job ids having spilled updates"""
+    if not os.path.isdir(SPARQL_SPILL_PATH):
+        return set()
+    return {name.split(".")[0] for name in os.listdir(SPARQL_SPILL_PATH) if name.endswith((".jsonl", ".jsonl.replaying"))}
@@ -0,0 +1,136 @@
+import hashlib
+import math
+import os
+from array import array
+
+# exact: 64-bit hashes of the urls (~21 bytes per url), bloom: bloom filter (~1.8 bytes per url at a false
+# positive rate of 1%, ~5.1 bytes per url at 0.1%), a false positive means a url is skipped as if it was
+# seen before
+SEEN_URLS_FILTER = os.getenv("SEEN_URLS_FILTER", "exact")
+SEEN_URLS_FALSE_POSITIVE_RATE = float(os.getenv("SEEN_URLS_FALSE_POSITIVE_RATE", "0.001"))
+
+
+def _hash64(key):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+
+class CompactUrlSet:
+    """
+    Set of urls (or other strings) keeping only a 64-bit hash per url, in an open addressing table backed
+    by an array instead of a set of str objects. Two urls sharing a hash are a chance of about n²/2^65.
+    """
+
+    def __init__(self, capacity=1024):
+        size = 1 << max(4, (2 * capacity - 1).bit_length())
+        self._table = array("Q", [0]) * size
+        self._len = 0
+
+    def _slot(self, h):
+        table = self._table
+        mask = len(table) - 1
+        i = h & mask
+        while table[i] and table[i] != h:
+            i = (i + 1) & mask
+        return i
+
+    def add(self, key):
+        h = _hash64(key)
+        i = self._slot(h)
+        if not self._table[i]:
+            self._table[i] = h
+            self._len += 1
+            if 2 * self._len > len(self._table):
+                self._grow()
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def _grow(self):
+        old = self._table
+        self._table = array("Q", [0]) * (2 * len(old))
+        for h in old:
+            if h:
+                self._table[self._slot(h)] = h
+
+    def __contains__(self, key):
+        return bool(self._table[self._slot(_hash64(key))])
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def nbytes(self):
+        return len(self._table) * self._table.itemsize
+
+
+class BloomFilter:
+    """
+    Scalable bloom filter: when a filter is full a new one with twice the capacity and half the false
+    positive rate is added, so the total false positive rate stays below `false_positive_rate`.
+    """
+
+    def __init__(self, false_positive_rate=SEEN_URLS_FALSE_POSITIVE_RATE, capacity=65536):
+        self.false_positive_rate = false_positive_rate
+        self._filters = []  # [bits, number of bits, number of hashes, capacity, count]
+        self._len = 0
+        self._add_filter(capacity)
+
+    def _add_filter(self, capacity):
+        rate = self.false_positive_rate / 2 ** (len(self._filters) + 1)
+        num_bits = math.ceil(-capacity * math.log(rate) / math.log(2) ** 2)
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        self._filters.append([bytearray((num_bits + 7) // 8), num_bits, num_hashes, capacity, 0])
+
+    @staticmethod
+    def _hashes(key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    @staticmethod
+    def _has_all(bits, num_bits, num_hashes, h1, h2):
+        for i in range(num_hashes):
+            p = (h1 + i * h2) % num_bits
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def _contains(self, h1, h2):
+        return any(self._has_all(bits, num_bits, num_hashes, h1, h2) for bits, num_bits, num_hashes, _, _ in self._filters)
+
+    def __contains__(self, key):
+        return self._contains(*self._hashes(key))
+
+    def add(self, key):
+        h1, h2 = self._hashes(key)
+        if self._contains(h1, h2):
+            return
+        current = self._filters[-1]
+        bits, num_bits, num_hashes, capacity, _ = current
+        for i in range(num_hashes):
+            p = (h1 + i * h2) % num_bits
+            bits[p >> 3] |= 1 << (p & 7)
+        current[4] += 1
+        self._len += 1
+        if current[4] >= capacity:
+            self._add_filter(2 * capacity)
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def nbytes(self):
+        return sum(len(bits) for bits, *_ in self._filters)
+
+
+def new_url_set(filter=SEEN_URLS_FILTER):
+    if filter == "bloom":
+        return BloomFilter()
+    if filter != "exact":
+        raise ValueError(f"unknown SEEN_URLS_FILTER {filter}, expected exact or bloom")
+    return CompactUrlSet()
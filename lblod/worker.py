@@ -0,0 +1,167 @@
+import os
+import threading
+from multiprocessing import Process, Queue
+
+from helpers import logger
+
+SHARED_CRAWLER_PROCESSES = int(os.getenv("SHARED_CRAWLER_PROCESSES", "0"))
+
+
+def _serve(jobs, results):
+    """Entry point of a shared crawler process: run every job received on `jobs` in the same reactor."""
+    from twisted.internet import reactor
+    from scrapy.crawler import Crawler, CrawlerRunner
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.ossignal import install_shutdown_handlers
+    from scrapy.utils.project import get_project_settings
+    from lblod.spiders.lblod import LBLODSpider
+    from lblod.checkpoint import crawl_settings
+
+    settings = get_project_settings()
+    configure_logging(settings)
+    runner = CrawlerRunner(settings)
+
+    stopping = threading.Event()
+
+    def shutdown(signum, _):
+        # a second signal while the crawls are writing their checkpoint must not stop the reactor twice
+        if stopping.is_set():
+            return
+        stopping.set()
+        # stop the crawls gracefully, so they write their checkpoint
+        logger.info(f"shared crawler process {os.getpid()} shutting down")
+        reactor.callFromThread(lambda: runner.stop().addBoth(lambda _: reactor.stop()))
+
+    def crawl(kwargs):
+        task = kwargs["task"]
+        logger.info(f"starting crawl for task {task} in shared crawler process {os.getpid()}")
+
+        def finished(_):
+            results.put((task, 0))
+
+        def failed(failure):
+            logger.error(f"crawl for task {task} failed: {failure.getErrorMessage()}")
+            results.put((task, 1))
+
+        crawler = Crawler(LBLODSpider, crawl_settings(settings, kwargs["job_id"]))
+        runner.crawl(crawler, **kwargs).addCallbacks(finished, failed)
+
+    def receive():
+        while True:
+            kwargs = jobs.get()
+            reactor.callFromThread(crawl, kwargs)
+
+    threading.Thread(target=receive, name="crawl-jobs", daemon=True).start()
+    install_shutdown_handlers(shutdown)
+    reactor.run(installSignalHandlers=False)
+
+
+class SharedCrawl:
+    """Stand-in for a Process running a single crawl, see SharedCrawlerProcess.submit"""
+
+    def __init__(self, crawler_process, task):
+        self.crawler_process = crawler_process
+        self.task = task
+
+    def is_alive(self):
+        return self.crawler_process.is_running(self.task)
+
+    @property
+    def exitcode(self):
+        return self.crawler_process.exitcode(self.task)
+
+    def terminate(self):
+        # stops the other crawls of the process as well, the process is only signalled once
+        self.crawler_process.terminate()
+
+    def join(self, timeout=None):
+        self.crawler_process.join(timeout)
+
+
+class SharedCrawlerProcess:
+    """
+    Long-lived process running many crawls in one reactor, so they share the interpreter, the imports,
+    the DNS cache and the per host concurrency limits (see HostConcurrencyMiddleware) instead of paying
+    for a process of their own.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.running = set()
+        self.exitcodes = {}
+        self.terminated = False
+        self.results = None
+        self.lock = threading.Lock()
+
+    def _check_alive(self):
+        if self.process and not self.process.is_alive():
+            logger.error(f"shared crawler process {self.process.pid} exited with {self.process.exitcode}")
+            for task in self.running:
+                self.exitcodes[task] = self.process.exitcode
+            self.running.clear()
+            self.process = None
+
+    def _ensure_started(self):
+        self._check_alive()
+        if self.process:
+            return
+        if self.results:
+            # stops the collector of the previous process once it has read what that process sent
+            self.results.put(None)
+        self.jobs = Queue()
+        self.results = Queue()
+        # daemonic, so it is stopped (gracefully, see _serve) when the web process exits without a shutdown
+        self.process = Process(target=_serve, args=(self.jobs, self.results), daemon=True)
+        self.terminated = False
+        self.process.start()
+        threading.Thread(target=self._collect, args=(self.results,), name="crawl-results", daemon=True).start()
+
+    def _collect(self, results):
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            task, exitcode = result
+            with self.lock:
+                self.running.discard(task)
+                self.exitcodes[task] = exitcode
+
+    def __len__(self):
+        with self.lock:
+            return len(self.running)
+
+    def submit(self, **kwargs):
+        with self.lock:
+            self._ensure_started()
+            self.running.add(kwargs["task"])
+            self.exitcodes.pop(kwargs["task"], None)
+            self.jobs.put(kwargs)
+        return SharedCrawl(self, kwargs["task"])
+
+    def is_running(self, task):
+        with self.lock:
+            self._check_alive()
+            return task in self.running
+
+    def exitcode(self, task):
+        return self.exitcodes.get(task)
+
+    def terminate(self):
+        with self.lock:
+            if self.process and not self.terminated:
+                self.terminated = True
+                self.process.terminate()
+
+    def join(self, timeout=None):
+        if self.process:
+            self.process.join(timeout)
+
+
+class SharedCrawlerPool:
+    """Spreads crawls over SHARED_CRAWLER_PROCESSES shared crawler processes, least busy first"""
+
+    def __init__(self, size=SHARED_CRAWLER_PROCESSES):
+        self.processes = [SharedCrawlerProcess() for _ in range(size)]
+
+    def submit(self, **kwargs):
+        return min(self.processes, key=len).submit(**kwargs)
@@ -0,0 +1,151 @@
+import time
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+
+from helpers import logger
+from sudo_query import update_sudo_async
+from .spill import spill
+from constants import SPARQL_BATCH_SIZE, SPARQL_BATCH_INTERVAL, SPARQL_BATCH_RETRIES
+
+
+class BatchedUpdateWriter:
+    """
+    Write-behind buffer for triplestore updates issued during a crawl.
+
+    Entries are added per kind, each kind has a builder turning a list of entries into a
+    single SPARQL update. A flush sends the updates of all kinds (in the order the builders
+    were given) as one request. Flushes happen when `batch_size` entries are waiting, every
+    `interval` seconds and on close. Only one batch is in flight at a time, so updates reach
+    the triplestore in the order they were added. A failed batch is retried (see
+    sudo_query.update_sudo_async); when it keeps failing it is appended to `spill_path`, as are
+    the batches after it, to be replayed once the triplestore is back (see lblod.spill).
+    """
+
+    def __init__(self, builders, stats=None, batch_size=SPARQL_BATCH_SIZE,
+                 interval=SPARQL_BATCH_INTERVAL / 1000, max_retries=SPARQL_BATCH_RETRIES,
+                 on_failure=None, spill_path=None):
+        self.builders = builders
+        self.stats = stats
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_retries = max_retries
+        self.on_failure = on_failure
+        self.spill_path = spill_path
+        self.spilling = False
+        self.buffer = {kind: [] for kind in builders}
+        self.writing = False
+        self._batch_waiters = []  # waiting for the entries that are currently buffered to be written
+        self._done_waiters = []  # waiting for the batch in flight to finish
+        self._loop = task.LoopingCall(self._write_next)
+
+    def start(self):
+        self._loop.start(self.interval, now=False)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.buffer.values())
+
+    def add(self, kind, entry):
+        """
+        Queue an entry. Returns a Deferred that fires once the entry is accepted; when the buffer is
+        full this waits for the running batch, so the crawl can't outrun the triplestore.
+        """
+        self.buffer[kind].append(entry)
+        self._set_stat("triplestore/buffered", len(self))
+        if len(self) >= self.batch_size:
+            self._write_next()
+        if self.writing and len(self) >= 4 * self.batch_size:
+            return self._wait_for_batch()
+        return defer.succeed(None)
+
+    def _wait_for_batch(self):
+        d = defer.Deferred()
+        self._done_waiters.append(d)
+        return d
+
+    def flush(self):
+        """Write everything that's buffered, returns a Deferred firing once it's written."""
+        if not len(self):
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._batch_waiters.append(d)
+        self._write_next()
+        return d
+
+    def _write_next(self):
+        if self.writing or not len(self):
+            return
+        self.writing = True
+        batch, self.buffer = self.buffer, {kind: [] for kind in self.builders}
+        self._set_stat("triplestore/buffered", 0)
+        waiters, self._batch_waiters = self._batch_waiters, []
+        d = self._write(batch)
+        d.addBoth(self._written, waiters)
+
+    def _written(self, result, waiters):
+        self.writing = False
+        if isinstance(result, Failure):
+            logger.error(f"Unexpected error writing batch: {result.getErrorMessage()}")
+        done_waiters, self._done_waiters = self._done_waiters, []
+        for d in done_waiters:
+            d.callback(None)
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+        if len(self) >= self.batch_size or self._batch_waiters:
+            self._write_next()
+
+    @defer.inlineCallbacks
+    def _write(self, batch):
+        queries = [self.builders[kind](entries) for kind, entries in batch.items() if entries]
+        size = sum(len(entries) for entries in batch.values())
+        query = " ;\n".join(queries)
+        # written, failed or spilled, see lblod.extensions.CrawlBudget
+        self._inc_stat("triplestore/batches_attempted")
+        if self.spilling:
+            # later batches may depend on the spilled ones (files on their remote data objects), keep the order
+            spill(self.spill_path, query)
+            self._inc_stat("triplestore/spilled_batches")
+            return
+        start = time.time()
+        try:
+            # retries wait on the reactor, meanwhile add() holds back the crawl once the buffer is full
+            yield update_sudo_async(query, max_retries=self.max_retries)
+        except Exception as e:
+            self._inc_stat("triplestore/batch_failures")
+            if self.spill_path:
+                logger.error(f"Writing batch of {size} entries failed after {self.max_retries + 1} attempts, "
+                             f"spilling it and the following batches to {self.spill_path}: {e}")
+                self.spilling = True
+                spill(self.spill_path, query)
+                self._inc_stat("triplestore/spilled_batches")
+            else:
+                logger.error(f"Writing batch of {size} entries failed after {self.max_retries + 1} attempts, giving up")
+                if self.on_failure:
+                    self.on_failure(e)
+            return
+        latency = time.time() - start
+        logger.info(f"wrote batch of {size} entries in {latency:.3f} seconds")
+        self._inc_stat("triplestore/batches")
+        self._inc_stat("triplestore/batch_entries", size)
+        self._inc_stat("triplestore/batch_latency_total", latency)
+        if self.stats:
+            self.stats.max_value("triplestore/batch_latency_max", latency)
+
+    def _inc_stat(self, key, count=1):
+        if self.stats:
+            self.stats.inc_value(key, count)
+
+    def _set_stat(self, key, value):
+        if self.stats:
+            self.stats.set_value(key, value)
+
+    @defer.inlineCallbacks
+    def close(self):
+        """Stop the timer and write whatever is left."""
+        if self._loop.running:
+            self._loop.stop()
+        while self.writing or len(self):
+            yield self.flush() if len(self) else self._wait_for_batch()
@@ -0,0 +1,183 @@
+"""
+Minimal Prometheus style metrics shared by the web process and the crawler processes.
+
+Every process keeps its metrics in `registry`. Crawler processes regularly write a snapshot of theirs to
+METRICS_PATH (see lblod.extensions.MetricsExporter), the web process merges these with its own when
+rendering `/metrics`.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_PATH = os.environ.get("METRICS_PATH", "/tmp/scraper-metrics")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# name: (type, help)
+METRICS = {
+    "scraper_jobs_running": ("gauge", "Crawls that are running"),
+    "scraper_jobs_queued": ("gauge", "Crawls waiting in the job queue"),
+    "scraper_job_pages_per_second": ("gauge", "Pages fetched per second by a running crawl, over the last interval"),
+    "scraper_job_pages_total": ("gauge", "Pages fetched by a running crawl"),
+    "scraper_job_items_total": ("gauge", "Pages stored by a running crawl"),
+    "scraper_job_pipeline_queue_depth": ("gauge", "Responses and items of a running crawl waiting for the pipeline"),
+    "scraper_job_triplestore_buffered": ("gauge", "Entries of a running crawl waiting to be written to the triplestore"),
+    "scraper_pages_fetched_total": ("counter", "Pages fetched"),
+    "scraper_items_stored_total": ("counter", "Pages stored"),
+    "scraper_retries_total": ("counter", "Requests retried"),
+    "scraper_response_latency_seconds": ("histogram", "Time to download a page"),
+    "scraper_storage_bytes_written_total": ("counter", "Bytes written to the file storage"),
+    "scraper_sparql_request_duration_seconds": ("histogram", "Duration of requests to the triplestore"),
+    "scraper_sparql_errors_total": ("counter", "Failed requests to the triplestore"),
+    "scraper_sparql_retries_total": ("counter", "Retried requests to the triplestore"),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels) -> value, or [bucket counts..., sum, count] for histograms
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.values.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def remove(self, **labels):
+        """Drop the series having all of the given labels, e.g. the gauges of a finished job"""
+        with self.lock:
+            for key in [key for key in self.values if set(labels.items()) <= set(key[1])]:
+                del self.values[key]
+
+    def snapshot(self):
+        with self.lock:
+            return [[name, dict(labels), value] for (name, labels), value in self.values.items()]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+registry = Registry()
+# crawler processes are forked from the web process, they start counting from zero
+os.register_at_fork(after_in_child=registry.clear)
+
+
+def merge(snapshots):
+    """Sum the snapshots of several processes"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            key = _key(name, labels)
+            if isinstance(value, list):
+                current = merged.setdefault(key, [0] * len(value))
+                merged[key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def render(values):
+    """Prometheus text exposition format of merged values"""
+    lines = []
+    for name, (type, help) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for labels, value in series:
+            if type == "histogram":
+                for bound, count in zip(LATENCY_BUCKETS, value):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {value[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def export_snapshot(path=METRICS_PATH):
+    """Write the metrics of this process for the web process to pick up"""
+    os.makedirs(path, exist_ok=True)
+    target = os.path.join(path, f"{os.getpid()}.json")
+    with open(f"{target}.tmp", "w") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(f"{target}.tmp", target)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# totals of the crawler processes that exited, so their counters keep counting
+_exited = []
+_collect_lock = threading.Lock()
+
+
+def collect(path=METRICS_PATH):
+    """Merged metrics of this process and the crawler processes that exported a snapshot"""
+    snapshots = [registry.snapshot()]
+    with _collect_lock:
+        for name in os.listdir(path) if os.path.isdir(path) else []:
+            if not name.endswith(".json"):
+                continue
+            file_path = os.path.join(path, name)
+            try:
+                with open(file_path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if _is_running(int(name[:-len(".json")])):
+                snapshots.append(snapshot)
+            else:
+                # the gauges of a process that exited are no longer current
+                counters = [entry for entry in snapshot if METRICS[entry[0]][0] != "gauge"]
+                _exited[:] = [[metric, dict(labels), value] for (metric, labels), value in merge([_exited, counters]).items()]
+                os.remove(file_path)
+        return merge(snapshots + [_exited])
@@ -0,0 +1,91 @@
+"""
+Retry policy for requests to the triplestore: exponential backoff with jitter, and a circuit breaker that
+stops sending requests for a while once the triplestore keeps failing.
+
+Only computes delays and keeps state, waiting is up to the caller: `sudo_query.update_sudo` sleeps (for
+threads and the web process), `sudo_query.update_sudo_async` waits on the reactor without holding a thread.
+"""
+import random
+import threading
+import time
+
+from constants import SPARQL_RETRY_BASE_DELAY, SPARQL_RETRY_MAX_DELAY, SPARQL_CIRCUIT_FAILURES, SPARQL_CIRCUIT_RESET
+
+
+class CircuitOpenError(Exception):
+    "Raised instead of sending a request while the circuit breaker is open"
+    pass
+
+
+class RetryPolicy:
+    def __init__(self, max_retries, base_delay=SPARQL_RETRY_BASE_DELAY, max_delay=SPARQL_RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempt):
+        return attempt < self.max_retries
+
+    def delay(self, attempt):
+        """Seconds to wait before retry `attempt` (0 based): full jitter, so retries of many clients spread out"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures: requests fail right away for `reset_timeout`
+    seconds, then one request is let through (half open). Its success closes the circuit, its failure
+    opens it again.
+    """
+
+    def __init__(self, failure_threshold=SPARQL_CIRCUIT_FAILURES, reset_timeout=SPARQL_CIRCUIT_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at < self.reset_timeout or self.probing:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        """Whether a request may be sent now, in half open state only the first caller gets to probe"""
+        with self.lock:
+            state = self._state()
+            if state == "half-open":
+                self.probing = True
+                return True
+            return state == "closed"
+
+    def retry_after(self):
+        """Seconds until the circuit lets a request through again, 0 when it's closed"""
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            if self.probing:
+                # another caller is finding out whether the triplestore is back, give it time to answer
+                return self.reset_timeout
+            return max(0, self.opened_at + self.reset_timeout - time.time())
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self.probing = False
@@ -1,59 +1,205 @@
 import datetime
 import os
+import re
+import threading
 import time
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+import requests
+from requests.adapters import HTTPAdapter
+
 from helpers import logger
-from constants import SPARQL_TIMEOUT
+from constants import SPARQL_TIMEOUT, SPARQL_THREADPOOL_SIZE, SPARQL_POOL_SIZE, SPARQL_UPDATE_RETRIES
+from metrics import registry
+from retry_policy import RetryPolicy, CircuitBreaker, CircuitOpenError
+
+_threadpool = None
+
+# operations that have to go to the update endpoint, after the PREFIX/BASE declarations
+_UPDATE_OPERATIONS = {"INSERT", "DELETE", "LOAD", "CLEAR", "CREATE", "DROP", "COPY", "MOVE", "ADD", "WITH"}
+_PROLOGUE = re.compile(r"(\s|#[^\n]*\n|PREFIX\s+[^:\s]*:\s*<[^>]*>|BASE\s*<[^>]*>)*", re.IGNORECASE)
+
+
+def is_update(the_query):
+    operation = the_query[_PROLOGUE.match(the_query).end():].split(None, 1)
+    return bool(operation) and operation[0].upper() in _UPDATE_OPERATIONS
+
+
+class SparqlClient:
+    """
+    Thread-safe SPARQL client keeping connections to the triplestore open between requests.
+
+    Every thread gets its own requests session (sessions hold cookies and other state), they share one
+    connection pool of `pool_size` connections per endpoint. Responses are gzip compressed.
+    """
+
+    def __init__(self, query_endpoint, update_endpoint, pool_size=SPARQL_POOL_SIZE, timeout=SPARQL_TIMEOUT):
+        self.query_endpoint = query_endpoint
+        self.update_endpoint = update_endpoint
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            session.headers.update({
+                "mu-auth-sudo": "true",
+                "Accept": "application/sparql-results+json, application/json",
+                "Accept-Encoding": "gzip"
+            })
+        return session
+
+    def _post(self, endpoint, data, timeout):
+        # POST, long queries (e.g. VALUES blocks) don't fit in a url
+        response = self._session().post(endpoint, data=data, timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response
 
-sparqlQuery = SPARQLWrapper(os.environ.get("MU_SPARQL_ENDPOINT"), returnFormat=JSON)
-sparqlQuery.addCustomHttpHeader("mu-auth-sudo", "true")
-sparqlQuery.setTimeout(SPARQL_TIMEOUT)
+    def query(self, the_query, timeout=None):
+        return self._post(self.query_endpoint, {"query": the_query}, timeout).json()
 
-sparqlUpdate = SPARQLWrapper(os.environ.get("MU_SPARQL_UPDATEPOINT"), returnFormat=JSON)
-sparqlUpdate.method = "POST"
-sparqlUpdate.addCustomHttpHeader("mu-auth-sudo", "true")
-sparqlUpdate.setTimeout(SPARQL_TIMEOUT)
+    def update(self, the_query, timeout=None):
+        self._post(self.update_endpoint, {"update": the_query}, timeout)
 
-authSparqlUpdate = SPARQLWrapper(os.environ.get("MU_AUTH_ENDPOINT"), returnFormat=JSON)
-authSparqlUpdate.method = "POST"
-authSparqlUpdate.addCustomHttpHeader("mu-auth-sudo", "true")
-authSparqlUpdate.setTimeout(SPARQL_TIMEOUT)
+    def close(self):
+        self.adapter.close()
 
 
+_client = None
+_client_lock = threading.Lock()
 
-def query_sudo(the_query):
+
+def sparql_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SparqlClient(os.environ.get("MU_SPARQL_ENDPOINT"), os.environ.get("MU_SPARQL_UPDATEPOINT"))
+        return _client
+
+
+# shared by everything in this process talking to the triplestore
+circuit_breaker = CircuitBreaker()
+
+
+def _reset_client():
+    # a forked crawler process must not share the connections of its parent
+    global _client, _client_lock, circuit_breaker
+    _client = None
+    _client_lock = threading.Lock()
+    circuit_breaker = CircuitBreaker()
+
+
+os.register_at_fork(after_in_child=_reset_client)
+
+
+def query_sudo(the_query, timeout=None):
     """Execute the given SPARQL query (select/ask/construct)on the triple store and returns the results
     in the given returnFormat (JSON by default)."""
     start = time.time()
     logger.debug(f"started query at {datetime.datetime.now()}")
     logger.debug("execute query: \n" + the_query)
-    sparqlQuery.setQuery(the_query)
+    try:
+        with registry.time("scraper_sparql_request_duration_seconds", type="query"):
+            results = sparql_client().query(the_query, timeout)
+    except Exception:
+        registry.inc("scraper_sparql_errors_total", type="query")
+        raise
     logger.debug(f"query took {time.time() - start} seconds")
-    return sparqlQuery.query().convert()
+    return results
 
 
-def update_sudo(the_query, attempt=0, max_retries=5):
-    """Execute the given update SPARQL query on the triple store,
-    if the given query is no update query, nothing happens."""
-    sparqlUpdate.setQuery(the_query)
-    if sparqlUpdate.isSparqlUpdateRequest():
-        try:
-            start = time.time()
-            logger.debug(f"started query at {datetime.datetime.now()}")
-            logger.debug("execute query: \n" + the_query)
+def _update_once(the_query, timeout=None):
+    """Send the update once, failures are counted by the circuit breaker"""
+    if not circuit_breaker.allow():
+        raise CircuitOpenError(f"triplestore unhealthy, not sending updates for {circuit_breaker.retry_after():.0f} seconds")
+    start = time.time()
+    logger.debug(f"started query at {datetime.datetime.now()}")
+    logger.debug("execute query: \n" + the_query)
+    try:
+        with registry.time("scraper_sparql_request_duration_seconds", type="update"):
+            sparql_client().update(the_query, timeout)
+    except Exception:
+        circuit_breaker.record_failure()
+        registry.inc("scraper_sparql_errors_total", type="update")
+        raise
+    circuit_breaker.record_success()
+    logger.debug(f"query took {time.time() - start} seconds")
 
-            sparqlUpdate.query()
 
-            logger.debug(f"query took {time.time() - start} seconds")
+def _retry_delay(policy, attempt, exception):
+    registry.inc("scraper_sparql_retries_total", type="update")
+    # no use trying before the circuit lets requests through again
+    delay = max(policy.delay(attempt), circuit_breaker.retry_after())
+    logger.warning(f"Executing update failed ({exception}), retrying after {delay:.1f} seconds [{attempt + 1}/{policy.max_retries}]")
+    return delay
+
+
+def update_sudo(the_query, attempt=0, max_retries=SPARQL_UPDATE_RETRIES, timeout=None):
+    """Execute the given update SPARQL query on the triple store,
+    if the given query is no update query, nothing happens.
+
+    Blocks while waiting to retry, only for the web process and its threads: crawler processes use
+    update_sudo_async (or defer_to_sparql_pool without retries) instead."""
+    if not is_update(the_query):
+        return
+    policy = RetryPolicy(max_retries)
+    while True:
+        try:
+            return _update_once(the_query, timeout)
         except Exception as e:
-            logger.warning("Executing query failed unexpectedly. Stacktrace:", exc_info=True)
-            if attempt <= max_retries:
-                wait_time = 0.6 * attempt + 30
-                logger.warn(f"Retrying after {wait_time} seconds [{attempt}/{max_retries}]")
-                time.sleep(wait_time)
-
-                update_sudo(the_query, attempt + 1, max_retries)
-            else:
-                logger.warn(f"Max attempts reached for query. Skipping.")
+            if not policy.should_retry(attempt):
+                logger.warning("Max attempts reached for query. Skipping.", exc_info=not isinstance(e, CircuitOpenError))
                 raise
+            time.sleep(_retry_delay(policy, attempt, e))
+            attempt += 1
+
+
+def _get_threadpool():
+    global _threadpool
+    if _threadpool is None:
+        # imported here so the web process doesn't need a reactor to use the blocking helpers
+        from twisted.internet import reactor
+        from twisted.python.threadpool import ThreadPool
+        _threadpool = ThreadPool(minthreads=1, maxthreads=SPARQL_THREADPOOL_SIZE, name="sparql")
+        _threadpool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _threadpool.stop)
+    return _threadpool
+
+
+def defer_to_sparql_pool(f, *args, **kwargs):
+    """Run a (blocking) function that talks to the triple store on the bounded SPARQL thread pool.
+    Returns a Deferred so it can be yielded from the crawl without blocking the reactor."""
+    from twisted.internet import reactor, threads
+    return threads.deferToThreadPool(reactor, _get_threadpool(), f, *args, **kwargs)
+
+
+def query_sudo_async(the_query):
+    """Non-blocking variant of query_sudo, returns a Deferred firing with the results."""
+    return defer_to_sparql_pool(query_sudo, the_query)
+
+
+def update_sudo_async(the_query, max_retries=SPARQL_UPDATE_RETRIES, timeout=None):
+    """Non-blocking variant of update_sudo, returns a Deferred firing once the update is done. Retries wait on
+    the reactor, they don't hold a thread of the SPARQL pool."""
+    from twisted.internet import defer, reactor, task
+
+    @defer.inlineCallbacks
+    def attempts():
+        policy = RetryPolicy(max_retries)
+        attempt = 0
+        while True:
+            try:
+                result = yield defer_to_sparql_pool(_update_once, the_query, timeout)
+                return result
+            except Exception as e:
+                if not policy.should_retry(attempt):
+                    raise
+                yield task.deferLater(reactor, _retry_delay(policy, attempt, e), lambda: None)
+                attempt += 1
+
+    if not is_update(the_query):
+        return defer.succeed(None)
+    return attempts()
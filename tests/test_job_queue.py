@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+os.environ.setdefault("DEFAULT_GRAPH", "http://mu.semte.ch/graphs/scraper-graph")
+
+job_queue = pytest.importorskip("lblod.job_queue")
+
+
+class FakeProcess:
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self.exitcode = None
+        self.terminated = False
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def terminate(self):
+        self.terminated = True
+        self.exitcode = 0
+
+    def join(self, timeout=None):
+        pass
+
+
+class FakeProcessFactory:
+    def __init__(self):
+        self.processes = []
+
+    def __call__(self, **kwargs):
+        process = FakeProcess(kwargs)
+        self.processes.append(process)
+        return process
+
+    def tasks(self):
+        return [process.kwargs["task"] for process in self.processes]
+
+
+@pytest.fixture
+def start_job():
+    return FakeProcessFactory()
+
+
+@pytest.fixture
+def new_queue(start_job, tmp_path):
+    path = str(tmp_path / "job-queue.sqlite")
+
+    def new_queue(**kwargs):
+        return job_queue.JobQueue(start_job, path=path, **kwargs)
+    return new_queue
+
+
+def enqueue(queue, task, host="example.org", kind="scheduled"):
+    queue.enqueue(kind, task=task, start_urls=[f"https://{host}/"], job_id=f"job-{task}")
+
+
+def dispatch(queue):
+    # one round of the job-queue thread
+    with queue.condition:
+        queue._reap()
+        queue._dispatch()
+
+
+def test_manual_jobs_before_scheduled(new_queue, start_job):
+    queue = new_queue(max_workers=1, max_jobs_per_host=2)
+    enqueue(queue, "scheduled-1", host="a.org")
+    enqueue(queue, "scheduled-2", host="b.org")
+    enqueue(queue, "manual", host="c.org", kind="manual")
+    dispatch(queue)
+    assert start_job.tasks() == ["manual"]
+    assert queue.job("job-scheduled-1")["position"] == 1
+    start_job.processes[-1].exitcode = 0
+    dispatch(queue)
+    # then in the order they were queued
+    assert start_job.tasks() == ["manual", "scheduled-1"]
+    assert queue.job("job-manual")["status"] == "done"
+
+
+def test_max_jobs_per_host(new_queue, start_job):
+    queue = new_queue(max_workers=4, max_jobs_per_host=1)
+    enqueue(queue, "a-1", host="a.org")
+    enqueue(queue, "a-2", host="a.org")
+    enqueue(queue, "b-1", host="b.org")
+    dispatch(queue)
+    # a-2 is skipped, not blocking the jobs behind it
+    assert start_job.tasks() == ["a-1", "b-1"]
+    assert queue.job("job-a-2")["status"] == "queued"
+    start_job.processes[0].exitcode = 1
+    dispatch(queue)
+    assert start_job.tasks() == ["a-1", "b-1", "a-2"]
+    assert queue.job("job-a-1")["status"] == "failed"
+
+
+def test_shutdown_and_recover(new_queue, start_job, monkeypatch):
+    queue = new_queue(max_workers=2)
+    enqueue(queue, "resumable", host="a.org")
+    enqueue(queue, "not-resumable", host="b.org")
+    enqueue(queue, "waiting", host="c.org")
+    dispatch(queue)
+    queue.shutdown(timeout=0)
+    assert all(process.terminated for process in start_job.processes)
+    assert queue.running == {}
+    assert queue.job("job-resumable")["status"] == "interrupted"
+
+    monkeypatch.setattr(job_queue, "is_resumable", lambda job_id: job_id == "job-resumable")
+    removed = []
+    monkeypatch.setattr(job_queue, "remove_checkpoint", removed.append)
+    # the next startup
+    queue = new_queue(max_workers=2)
+    assert sorted(queue.recover()) == ["resumable", "waiting"]
+    assert queue.job("job-not-resumable")["status"] == "failed"
+    assert removed == ["job-not-resumable"]
+    dispatch(queue)
+    assert start_job.tasks()[2:] == ["resumable", "waiting"]
+
+
+def test_recover_after_crash(new_queue, start_job, monkeypatch):
+    queue = new_queue()
+    enqueue(queue, "crashed")
+    dispatch(queue)
+    monkeypatch.setattr(job_queue, "is_resumable", lambda job_id: True)
+    # no shutdown, the job is still marked running
+    assert new_queue().recover() == ["crashed"]
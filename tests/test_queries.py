@@ -0,0 +1,88 @@
+import datetime
+import os
+
+import pytest
+
+os.environ.setdefault("DEFAULT_GRAPH", "http://mu.semte.ch/graphs/scraper-graph")
+
+pytest.importorskip("escape_helpers")
+
+from escape_helpers import sparql_escape_string, sparql_escape_uri
+from constants import TASK_STATUSES
+from lblod.file import construct_insert_files_query
+from lblod.harvester import construct_insert_remote_data_objects_query, new_remote_data_object
+from lblod.job import construct_update_task_status_query
+
+GRAPH = "http://mu.semte.ch/graphs/scraper-graph"
+# would end the uri or string early if it wasn't escaped
+ODD_URI = "http://example.org/a>b"
+ODD_STRING = 'page "quoted" """ name'
+
+
+def file_entry(i, name=None, remote_data_object=None):
+    file = {
+        "remote_data_object": remote_data_object or f"http://data.lblod.info/id/remote-data-objects/{i}",
+        "mimetype": "text/html",
+        "created": datetime.datetime(2024, 6, 1),
+        "size": 100 + i,
+        "extension": "html",
+        "doc_type": None
+    }
+    physical_file = {
+        "uri": f"share://{i}/scrape/{i}.html.gz",
+        "uuid": str(i),
+        "name": name or f"{i}.html.gz"
+    }
+    return file, physical_file
+
+
+def values_rows(query):
+    block = query.split("VALUES", 1)[1].split("{", 1)[1].split("}", 1)[0]
+    return [line.strip() for line in block.strip().splitlines()]
+
+
+def test_files_query_has_a_values_row_per_file():
+    query = construct_insert_files_query([file_entry(i) for i in range(3)], GRAPH)
+    rows = values_rows(query)
+    assert len(rows) == 3
+    assert all(row.startswith(f"({sparql_escape_uri(f'http://data.lblod.info/id/remote-data-objects/{i}')}")
+               for i, row in enumerate(rows))
+    # files without a document type are documents
+    assert all(row.endswith(f"{sparql_escape_uri('http://xmlns.com/foaf/0.1/Document')})") for row in rows)
+
+
+def test_files_query_escapes_values():
+    query = construct_insert_files_query([file_entry(0, name=ODD_STRING, remote_data_object=ODD_URI)], GRAPH)
+    assert sparql_escape_string(ODD_STRING) in query
+    assert sparql_escape_uri(ODD_URI) in query
+    assert ODD_URI not in query
+
+
+def test_remote_data_objects_query_inserts_every_object():
+    rdos = [new_remote_data_object(f"https://example.org/besluiten/{i}") for i in range(3)]
+    query = construct_insert_remote_data_objects_query("http://data.lblod.info/id/collections/1", rdos)
+    assert query.count("a nfo:RemoteDataObject") == 3
+    for rdo in rdos:
+        assert f"{sparql_escape_uri('http://data.lblod.info/id/collections/1')} dct:hasPart {sparql_escape_uri(rdo['uri'])}." in query
+        assert f"nie:url {sparql_escape_uri(rdo['url'])}" in query
+        assert sparql_escape_string(rdo["uuid"]) in query
+
+
+def test_remote_data_objects_query_escapes_and_cleans_urls():
+    rdo = new_remote_data_object(ODD_URI + ";jsessionid=ABC123#top")
+    query = construct_insert_remote_data_objects_query("http://data.lblod.info/id/collections/1", [rdo])
+    assert f"nie:url {sparql_escape_uri(ODD_URI)};" in query
+    assert ODD_URI not in query
+
+
+def test_no_remote_data_objects_query_is_valid():
+    query = construct_insert_remote_data_objects_query("http://data.lblod.info/id/collections/1", [])
+    assert "INSERT DATA" in query
+    assert "nfo:RemoteDataObject" not in query
+
+
+def test_task_status_query_escapes_task():
+    query = construct_update_task_status_query(ODD_URI, TASK_STATUSES["FAILED"], GRAPH)
+    assert f"{sparql_escape_uri(ODD_URI)} adms:status {sparql_escape_uri(TASK_STATUSES['FAILED'])}." in query
+    assert ODD_URI not in query
+    assert query.count(sparql_escape_uri(GRAPH)) == 3
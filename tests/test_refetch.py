@@ -0,0 +1,41 @@
+import datetime
+
+from lblod.refetch import RefetchPolicy
+
+NOW = datetime.datetime(2024, 6, 1)
+URLS = [f"https://example.org/besluiten/{i}" for i in range(1000)]
+
+
+def days_ago(days):
+    return (NOW - datetime.timedelta(days=days)).isoformat()
+
+
+def test_every_url_refetched_once_per_cycle():
+    # a cycle is 1/fraction consecutive runs, wherever it starts
+    for first_run in (0, 7):
+        policies = [RefetchPolicy(run, fraction=0.1, now=NOW) for run in range(first_run, first_run + 10)]
+        for url in URLS:
+            assert sum(policy.is_due(url, days_ago(1)) for policy in policies) == 1
+
+
+def test_windows_are_about_even():
+    due = sum(RefetchPolicy(3, fraction=0.1, now=NOW).is_due(url, days_ago(1)) for url in URLS)
+    assert 50 <= due <= 150
+
+
+def test_windows_repeat_every_cycle():
+    assert [RefetchPolicy(4, fraction=0.25, now=NOW).is_due(url) for url in URLS] == \
+        [RefetchPolicy(8, fraction=0.25, now=NOW).is_due(url) for url in URLS]
+
+
+def test_old_pages_always_refetched():
+    policy = RefetchPolicy(0, fraction=0.1, max_age_days=30, now=NOW)
+    assert all(policy.is_due(url, days_ago(31)) for url in URLS)
+    # pages imported from the triplestore have no fetch time, they wait for their window
+    assert not all(policy.is_due(url, None) for url in URLS)
+
+
+def test_no_fraction_only_refetches_old_pages():
+    policy = RefetchPolicy(0, fraction=0, max_age_days=30, now=NOW)
+    assert not any(policy.is_due(url, days_ago(29)) for url in URLS)
+    assert all(policy.is_due(url, days_ago(31)) for url in URLS)
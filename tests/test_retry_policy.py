@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+os.environ.setdefault("DEFAULT_GRAPH", "http://mu.semte.ch/graphs/scraper-graph")
+
+from retry_policy import CircuitBreaker, RetryPolicy
+
+
+def open_breaker(reset_timeout):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_and_closes_after_probe():
+    breaker = open_breaker(0.05)
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.retry_after() == 0
+
+
+def test_concurrent_callers_wait_for_probe():
+    breaker = open_breaker(0.05)
+    time.sleep(0.06)
+    allowed = []
+    callers = [threading.Thread(target=lambda: allowed.append(breaker.allow())) for _ in range(2)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    # one probes, the other has to wait for the probe instead of retrying right away
+    assert sorted(allowed) == [False, True]
+    assert breaker.state == "open"
+    assert breaker.retry_after() >= 0.05
+
+
+class SlowRecoveringTriplestore(BaseHTTPRequestHandler):
+    delay = 0.3
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def triplestore(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowRecoveringTriplestore)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/sparql"
+    sudo_query = pytest.importorskip("sudo_query")
+    monkeypatch.setattr(sudo_query, "_client", sudo_query.SparqlClient(url, url))
+    yield sudo_query
+    server.shutdown()
+
+
+def test_concurrent_updates_during_probe_succeed(triplestore, monkeypatch):
+    sudo_query = triplestore
+    breaker = open_breaker(0.2)
+    monkeypatch.setattr(sudo_query, "circuit_breaker", breaker)
+    # backoff alone is much shorter than the probe
+    monkeypatch.setattr(sudo_query, "RetryPolicy", lambda max_retries: RetryPolicy(max_retries, base_delay=0.01, max_delay=0.01))
+    time.sleep(0.25)
+    errors = []
+
+    def update():
+        try:
+            sudo_query.update_sudo("INSERT DATA { <s> <p> <o> }", max_retries=2)
+        except Exception as e:
+            errors.append(e)
+
+    callers = [threading.Thread(target=update) for _ in range(2)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    # the caller that didn't probe waited for the probe rather than using up its retries
+    assert errors == []
+    assert breaker.state == "closed"
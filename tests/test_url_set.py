@@ -0,0 +1,56 @@
+import pytest
+
+from lblod.url_set import BloomFilter, CompactUrlSet
+
+URL = "https://example.org/besluiten/{}"
+
+
+def urls(start, stop):
+    return [URL.format(i) for i in range(start, stop)]
+
+
+@pytest.mark.parametrize("url_set", [CompactUrlSet(), BloomFilter(capacity=1000)], ids=["exact", "bloom"])
+def test_no_false_negatives(url_set):
+    # past the initial capacity, so the table grows and the bloom filter adds filters
+    added = urls(0, 20000)
+    url_set.update(added)
+    assert all(url in url_set for url in added)
+    # a bloom filter doesn't count urls it mistakes for seen ones
+    url_set.update(added)
+    assert 0.999 * 20000 <= len(url_set) <= 20000
+
+
+def test_exact_has_no_false_positives():
+    url_set = CompactUrlSet()
+    url_set.update(urls(0, 20000))
+    assert not any(url in url_set for url in urls(20000, 60000))
+
+
+def test_bloom_false_positive_rate():
+    url_set = BloomFilter(false_positive_rate=0.001)
+    # fills the first two filters
+    url_set.update(urls(0, 200000))
+    false_positives = sum(url in url_set for url in urls(200000, 300000))
+    assert false_positives / 100000 <= 0.001
+
+
+@pytest.mark.parametrize("filter", ["exact", "bloom"])
+def test_dupe_filter_persists_seen_requests(filter, tmp_path, monkeypatch):
+    pytest.importorskip("scrapy")
+    from scrapy import Request
+    from lblod import dupefilters
+    from lblod.url_set import new_url_set
+    monkeypatch.setattr(dupefilters, "new_url_set", lambda: new_url_set(filter))
+
+    dupefilter = dupefilters.CompactDupeFilter(str(tmp_path))
+    assert not dupefilter.request_seen(Request(URL.format(1)))
+    assert dupefilter.request_seen(Request(URL.format(1)))
+    assert not dupefilter.request_seen(Request(URL.format(2)))
+    dupefilter.close("shutdown")
+
+    # resumed from the same JOBDIR
+    resumed = dupefilters.CompactDupeFilter(str(tmp_path))
+    assert resumed.request_seen(Request(URL.format(1)))
+    assert resumed.request_seen(Request(URL.format(2)))
+    assert not resumed.request_seen(Request(URL.format(3)))
+    resumed.close("finished")
@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault("DEFAULT_GRAPH", "http://mu.semte.ch/graphs/scraper-graph")
+
+pytest.importorskip("scrapy")
+worker = pytest.importorskip("lblod.worker")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# long enough for the shared process to import scrapy and start its reactor
+STARTUP_SECONDS = 5
+
+
+def start_shared_process():
+    crawler_process = worker.SharedCrawlerProcess()
+    with crawler_process.lock:
+        crawler_process._ensure_started()
+    time.sleep(STARTUP_SECONDS)
+    return crawler_process
+
+
+def test_shutdown_reaps_shared_process():
+    crawler_process = start_shared_process()
+    process = crawler_process.process
+    # what JobQueue.shutdown does for two crawls running in the same process
+    crawls = [worker.SharedCrawl(crawler_process, f"http://t/{i}") for i in range(2)]
+    for crawl in crawls:
+        crawl.terminate()
+    for crawl in crawls:
+        crawl.join(30)
+    assert not process.is_alive()
+    # stopped by its own shutdown handler, not killed by the signal
+    assert process.exitcode == 0
+
+
+def test_second_signal_during_shutdown():
+    crawler_process = start_shared_process()
+    process = crawler_process.process
+    process.terminate()
+    time.sleep(0.1)
+    process.terminate()
+    process.join(30)
+    assert not process.is_alive()
+    assert process.exitcode == 0
+
+
+def test_exit_without_shutdown_stops_shared_process():
+    script = textwrap.dedent(f"""
+        import time
+        from lblod.worker import SharedCrawlerProcess
+        crawler_process = SharedCrawlerProcess()
+        with crawler_process.lock:
+            crawler_process._ensure_started()
+        time.sleep({STARTUP_SECONDS})
+        print(crawler_process.process.pid)
+    """)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, env=env, timeout=60, check=True,
+                            capture_output=True, text=True).stdout
+    pid = int(output.split()[-1])
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+def exit_right_away(jobs, results):
+    pass
+
+
+def collectors():
+    return [thread for thread in threading.enumerate() if thread.name == "crawl-results"]
+
+
+def test_restart_stops_previous_collector(monkeypatch):
+    monkeypatch.setattr(worker, "_serve", exit_right_away)
+    before = len(collectors())
+    crawler_process = worker.SharedCrawlerProcess()
+    for _ in range(3):
+        with crawler_process.lock:
+            crawler_process._ensure_started()
+        crawler_process.process.join(10)
+    time.sleep(0.5)
+    # only the collector of the last process is left
+    assert len(collectors()) == before + 1
+    assert len(crawler_process) == 0
@@ -0,0 +1,155 @@
+import json
+import os
+
+import pytest
+
+os.environ.setdefault("DEFAULT_GRAPH", "http://mu.semte.ch/graphs/scraper-graph")
+
+pytest.importorskip("twisted")
+writer_module = pytest.importorskip("lblod.writer")
+spill_module = pytest.importorskip("lblod.spill")
+
+from twisted.internet import defer, task
+
+BUILDERS = {
+    "remote_data_objects": lambda entries: "rdos " + ",".join(entries),
+    "files": lambda entries: "files " + ",".join(entries),
+}
+
+
+class FakeTriplestore:
+    """Stands in for update_sudo_async, batches stay in flight until answered"""
+
+    def __init__(self):
+        self.queries = []
+        self.in_flight = []
+
+    def __call__(self, query, max_retries=None, timeout=None):
+        self.queries.append(query)
+        d = defer.Deferred()
+        self.in_flight.append(d)
+        return d
+
+    def succeed(self):
+        self.in_flight.pop(0).callback(None)
+
+    def fail(self):
+        self.in_flight.pop(0).errback(Exception("triplestore down"))
+
+
+@pytest.fixture
+def triplestore(monkeypatch):
+    fake = FakeTriplestore()
+    monkeypatch.setattr(writer_module, "update_sudo_async", fake)
+    return fake
+
+
+def new_writer(batch_size=3, **kwargs):
+    writer = writer_module.BatchedUpdateWriter(BUILDERS, batch_size=batch_size, interval=1, **kwargs)
+    writer._loop.clock = task.Clock()
+    return writer
+
+
+def test_flush_on_size(triplestore):
+    writer = new_writer()
+    writer.add("remote_data_objects", "a")
+    writer.add("files", "b")
+    assert triplestore.queries == []
+    writer.add("files", "c")
+    # all kinds in one request, in the order of the builders
+    assert triplestore.queries == ["rdos a ;\nfiles b,c"]
+    assert len(writer) == 0
+
+
+def test_flush_on_interval(triplestore):
+    writer = new_writer()
+    writer.start()
+    writer.add("files", "a")
+    assert triplestore.queries == []
+    writer._loop.clock.advance(1)
+    assert triplestore.queries == ["files a"]
+
+
+def test_flush_on_close(triplestore):
+    writer = new_writer()
+    writer.start()
+    writer.add("files", "a")
+    closed = writer.close()
+    assert triplestore.queries == ["files a"]
+    assert not closed.called
+    triplestore.succeed()
+    assert closed.called
+    assert not writer._loop.running
+
+
+def test_one_batch_in_flight(triplestore):
+    writer = new_writer()
+    for entry in "abcdef":
+        writer.add("files", entry)
+    # the second batch waits for the first one
+    assert triplestore.queries == ["files a,b,c"]
+    assert len(writer) == 3
+    triplestore.succeed()
+    assert triplestore.queries == ["files a,b,c", "files d,e,f"]
+
+
+def test_backpressure_when_buffer_full(triplestore):
+    writer = new_writer(batch_size=2)
+    accepted = [writer.add("files", str(i)) for i in range(10)]
+    # 2 in flight, the crawl is held back once 4 * batch_size entries are waiting
+    assert all(d.called for d in accepted[:9])
+    assert not accepted[9].called
+    triplestore.succeed()
+    assert accepted[9].called
+
+
+def test_spilling_is_sticky_and_keeps_order(triplestore, tmp_path):
+    path = str(tmp_path / "job.jsonl")
+    writer = new_writer(spill_path=path)
+    for entry in "abc":
+        writer.add("files", entry)
+    triplestore.fail()
+    for entry in "defghi":
+        writer.add("files", entry)
+    closed = writer.close()
+    assert closed.called
+    # later batches are spilled without trying the triplestore again
+    assert triplestore.queries == ["files a,b,c"]
+    with open(path) as f:
+        spilled = [json.loads(line)["query"] for line in f]
+    assert spilled == ["files a,b,c", "files d,e,f", "files g,h,i"]
+
+
+def test_failure_without_spill_path(triplestore):
+    failures = []
+    writer = new_writer(on_failure=failures.append)
+    for entry in "abc":
+        writer.add("files", entry)
+    triplestore.fail()
+    assert len(failures) == 1
+    writer.add("files", "d")
+    writer.close()
+    assert triplestore.queries == ["files a,b,c", "files d"]
+
+
+def test_replay_keeps_what_failed_in_order(monkeypatch, tmp_path):
+    path = str(tmp_path / "job.jsonl")
+    for query in ["q1", "q2", "q3"]:
+        spill_module.spill(path, query)
+    written = []
+
+    def down_at_q2(query, max_retries=None):
+        if query == "q2":
+            raise Exception("triplestore down")
+        written.append(query)
+
+    monkeypatch.setattr(spill_module, "update_sudo", down_at_q2)
+    assert not spill_module.replay(path)
+    assert spill_module.has_spilled(path)
+    # spilled while the first replay was left unfinished
+    spill_module.spill(path, "q4")
+
+    monkeypatch.setattr(spill_module, "update_sudo", lambda query, max_retries=None: written.append(query))
+    assert spill_module.replay(path)
+    assert written == ["q1", "q2", "q3", "q4"]
+    assert not spill_module.has_spilled(path)
@@ -1,37 +1,120 @@
+import time
+_import_started = time.time()
+
 import os
+import re
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process
 
-from flask import jsonify, request
+from flask import jsonify, request, Response
 from werkzeug.exceptions import NotFound
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-
-from scrapy.crawler import CrawlerProcess
-from scrapy.utils.project import get_project_settings
-from lblod.spiders.lblod import LBLODSpider
-from lblod.job import load_task, update_task_status, TaskNotFoundException, fail_busy_and_scheduled_tasks
-from lblod.harvester import get_harvest_collection_for_task, get_initial_remote_data_object
+# the crawl stack (scrapy, twisted, rdflib) is only imported by the crawler processes, see run_spider
+from lblod.job import load_tasks, update_tasks_status, fail_busy_and_scheduled_tasks
+from lblod.harvester import get_harvest_collections_for_tasks, get_initial_remote_data_objects
+from lblod.job_queue import JobQueue
+from lblod.worker import SharedCrawlerPool, SHARED_CRAWLER_PROCESSES
+from lblod.checkpoint import crawl_settings
+from lblod.progress import read_progress
+from lblod.spill import spilled_jobs, spill_path, replay
 from helpers import logger, generate_uuid
 from constants import OPERATIONS, TASK_STATUSES, RESOURCE_BASE
+from metrics import registry, collect, render
 
 AUTO_RUN = os.getenv("AUTO_RUN") in ["yes", "on", "true", True, "1", 1]
 DEFAULT_GRAPH = os.getenv("DEFAULT_GRAPH", "http://mu.semte.ch/graphs/scraper-graph")
 MU_APPLICATION_FILE_STORAGE_PATH = os.getenv("MU_APPLICATION_FILE_STORAGE_PATH", "")
+# scheduled tasks of a delta are loaded and dispatched this many at a time
+DELTA_BATCH_SIZE = int(os.getenv("DELTA_BATCH_SIZE", "100"))
 
 
-# on startup fail existing busy tasks
-fail_busy_and_scheduled_tasks()
+# seconds between attempts to fail the tasks left busy by the previous run, when the triplestore isn't up yet
+RECOVERY_RETRY_INTERVAL = int(os.getenv("RECOVERY_RETRY_INTERVAL", "10"))
+# seconds between attempts to write the updates crawls had to spill (see lblod.spill)
+SPARQL_SPILL_REPLAY_INTERVAL = int(os.getenv("SPARQL_SPILL_REPLAY_INTERVAL", "300"))
 
-def run_spider(spider, **kwargs):
+
+def run_spider(**kwargs):
     def _run():
-        crawler_process = CrawlerProcess(get_project_settings())
-        crawler_process.crawl(spider, **kwargs)
+        from scrapy.crawler import CrawlerProcess
+        from scrapy.utils.project import get_project_settings
+        from lblod.spiders.lblod import LBLODSpider
+
+        crawler_process = CrawlerProcess(crawl_settings(get_project_settings(), kwargs["job_id"]))
+        crawler_process.crawl(LBLODSpider, **kwargs)
         crawler_process.start()
 
     process = Process(target=_run)
     process.start()
     return process
+
+if SHARED_CRAWLER_PROCESSES:
+    # run the queued jobs in a few long-lived processes instead of a process per job
+    job_queue = JobQueue(SharedCrawlerPool().submit)
+else:
+    job_queue = JobQueue(run_spider)
+# local, the interrupted jobs that can be resumed are queued again right away
+resumed_tasks = job_queue.recover()
+job_queue.start()
+
+startup = {"recovered": threading.Event(), "error": None, "attempts": 0, "seconds": None}
+
+
+def recover_tasks():
+    """
+    Fail the tasks left busy or scheduled by the previous run, except for the ones still queued. Runs in
+    the background and retries until the triplestore answers, deltas wait for it (see dispatch_scheduled_tasks).
+    """
+    while True:
+        startup["attempts"] += 1
+        try:
+            fail_busy_and_scheduled_tasks(keep=resumed_tasks)
+            break
+        except Exception as e:
+            startup["error"] = str(e)
+            logger.warning(f"failing the tasks of the previous run failed, retrying in {RECOVERY_RETRY_INTERVAL} seconds: {e}")
+            time.sleep(RECOVERY_RETRY_INTERVAL)
+    startup["error"] = None
+    startup["recovered"].set()
+    logger.info(f"recovered the tasks of the previous run after {startup['attempts']} attempt(s)")
+
+threading.Thread(target=recover_tasks, name="recovery", daemon=True).start()
+
+
+def replay_spilled_updates():
+    """Write the updates crawls spilled and couldn't replay themselves, of jobs that are no longer running"""
+    startup["recovered"].wait()
+    while True:
+        for job_id in spilled_jobs():
+            queued = job_queue.job(job_id)
+            # queued or running crawls replay their own spill file when they close
+            if queued and queued["status"] in ("queued", "running"):
+                continue
+            try:
+                replay(spill_path(job_id))
+            except Exception:
+                logger.exception(f"replaying the spilled updates of job {job_id} failed")
+        time.sleep(SPARQL_SPILL_REPLAY_INTERVAL)
+
+threading.Thread(target=replay_spilled_updates, name="spill-replay", daemon=True).start()
+
+
+def _shutdown(signum, frame, previous_handler=signal.getsignal(signal.SIGTERM)):
+    # let running crawls checkpoint before the service stops, they are resumed on the next startup
+    job_queue.shutdown()
+    if callable(previous_handler):
+        previous_handler(signum, frame)
+    else:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+try:
+    signal.signal(signal.SIGTERM, _shutdown)
+except ValueError:
+    logger.warning("not running in the main thread, running crawls won't be checkpointed on shutdown")
+
 @app.route("/scrape", methods=["POST"])
 def scrape():
     if "url" in request.args:
@@ -39,8 +122,13 @@ def scrape():
         job_id = generate_uuid()
         collection = f"{RESOURCE_BASE}harvesting-collections/{generate_uuid()}"
         task = f"{RESOURCE_BASE}tasks/{generate_uuid()}"
-        run_spider(LBLODSpider, start_urls=start_urls, collection=collection, task=task, job_id=job_id)
-        return jsonify({"message": "Scraping started", "job_id": job_id})
+        # optional budgets of this job, see lblod.extensions.CrawlBudget
+        budgets = {
+            f"budget_{budget}": float(request.args[f"budget_{budget}"])
+            for budget in ["seconds", "bytes", "sparql_writes"] if f"budget_{budget}" in request.args
+        }
+        job_queue.enqueue("manual", start_urls=start_urls, collection=collection, task=task, job_id=job_id, **budgets)
+        return jsonify({"message": "Scraping queued", "job_id": job_id})
     else:
         return jsonify({"error": "URL parameter is missing"})
 
@@ -62,15 +150,76 @@ def delta_handler():
         logger.info("delta did not contain scheduled tasks?")
         return jsonify({"message": "delta didn't contain download jobs, ignoring"})
 
-    for uri in scheduled_tasks:
-        try:
-            logger.info(f"loading task {uri}")
-            task = load_task(uri)
-            if (task["operation"] == OPERATIONS["COLLECTING"]):
-                update_task_status(task["uri"], TASK_STATUSES["BUSY"])
-                collection = get_harvest_collection_for_task(task)
-                rdo = get_initial_remote_data_object(collection)
-                run_spider(LBLODSpider, start_urls=[rdo["url"]], collection = collection, task = uri, job_id = task["job_id"])
-        except TaskNotFoundException:
-          logger.debug(f"no task found for {uri}")
+    # answer the delta-notifier right away, one dispatcher so bursts of deltas don't race each other
+    delta_dispatcher.submit(dispatch_scheduled_tasks, scheduled_tasks)
     return jsonify({"message": "thanks for all the fish!"})
+
+delta_dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="delta")
+
+def dispatch_scheduled_tasks(scheduled_tasks):
+    # tasks marked busy before the recovery ran would be failed by it
+    startup["recovered"].wait()
+    for i in range(0, len(scheduled_tasks), DELTA_BATCH_SIZE):
+        batch = list(dict.fromkeys(scheduled_tasks[i:i + DELTA_BATCH_SIZE]))
+        try:
+            dispatch_batch(batch)
+        except Exception:
+            logger.exception(f"failed to dispatch scheduled tasks {batch}")
+
+def dispatch_batch(uris):
+    logger.info(f"loading {len(uris)} tasks")
+    tasks = load_tasks(uris)
+    for uri in uris:
+        if uri not in tasks:
+            logger.debug(f"no task found for {uri}")
+    # still scheduled, the same task may be in several deltas
+    collecting = [uri for uri, task in tasks.items()
+                  if task["operation"] == OPERATIONS["COLLECTING"] and task["status"] == TASK_STATUSES["SCHEDULED"]]
+    if not collecting:
+        return
+    collections = get_harvest_collections_for_tasks(collecting)
+    rdos = get_initial_remote_data_objects(set(collections.values()))
+    ready = [uri for uri in collecting if rdos.get(collections.get(uri))]
+    unusable = [uri for uri in collecting if uri not in ready]
+    if unusable:
+        logger.error(f"tasks {unusable} don't have a harvesting collection with one remote data object, failing them")
+        update_tasks_status(unusable, TASK_STATUSES["FAILED"])
+    update_tasks_status(ready, TASK_STATUSES["BUSY"])
+    for uri in ready:
+        collection = collections[uri]
+        job_queue.enqueue("scheduled", start_urls=[rdos[collection]["url"]], collection = collection, task = uri, job_id = tasks[uri]["job_id"])
+
+@app.route("/queue", methods=["GET"])
+def queue_metrics():
+    return jsonify(job_queue.metrics())
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_progress(job_id):
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", job_id):
+        raise NotFound()
+    queued = job_queue.job(job_id)
+    progress = read_progress(job_id)
+    if not queued and not progress:
+        raise NotFound()
+    return jsonify({"job_id": job_id, "queue": queued, "progress": progress})
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    queue = job_queue.metrics()
+    registry.set("scraper_jobs_running", queue["running"])
+    registry.set("scraper_jobs_queued", queue["queued"])
+    return Response(render(collect()), mimetype="text/plain; version=0.0.4")
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    recovered = startup["recovered"].is_set()
+    body = {
+        "ready": recovered,
+        "startup_seconds": startup["seconds"],
+        "recovery_attempts": startup["attempts"],
+        "recovery_error": startup["error"]
+    }
+    return jsonify(body), 200 if recovered else 503
+
+startup["seconds"] = time.time() - _import_started
+logger.info(f"scraper service loaded in {startup['seconds']:.3f} seconds")